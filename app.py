@@ -1,39 +1,52 @@
+import io
 import os
+import csv
+import json
+import math
+import zlib
+import heapq
+import multiprocessing
+import queue
+import hashlib
+import hmac
 import random
 import string
 import sqlite3
-from datetime import datetime
-from flask import g
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import g, has_app_context
 from markupsafe import Markup
+import click
 from flask import (
     Flask,
     render_template,
+    stream_template,
     request,
     redirect,
     url_for,
     flash,
     session,
     jsonify,   # <--- add this
+    Response,
 )
 
 import qrcode   # <--- add this
+import qrcode.image.svg
+
+from ticket_codes import load_signing_key, sign_ticket_code, verify_ticket_code
+
+# Creates ticket_key.secret with a random key on first start (unless SCANPAYGO_TICKET_KEY is set)
+load_signing_key(create=True)
 
 app = Flask(__name__)
 app.secret_key = "super_secret_scanpaygo_key"
 # Simple admin credentials (change for your project/demo)
 @app.context_processor
 def inject_user_and_wallet():
-    user_id = session.get("user_id")
-    if not user_id:
-        return {"current_user": None, "wallet_balance": None}
-
-    conn = get_db_connection()
-    user = conn.execute(
-        "SELECT id, name, email, wallet_balance FROM users WHERE id = ?",
-        (user_id,)
-    ).fetchone()
-    conn.close()
-
+    user = get_current_user()
     if not user:
         return {"current_user": None, "wallet_balance": None}
 
@@ -45,24 +58,94 @@ def inject_user_and_wallet():
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"   # change this before submitting!
 DEPOSIT_PERCENT = 0.15   # 15% deposit 
-DB_NAME = "tickets.db"
-QR_FOLDER = os.path.join("static", "qr")
+SEAT_HOLD_TTL = 300      # seconds a picked seat stays reserved before booking
+SYNC_BATCH_MAX = 200     # offline scanner payments accepted per /api/sync_payments call
+PAYMENT_REQUEST_TTL = 7 * 24 * 3600   # seconds an idempotency key is remembered (offline scanners sync late)
+VALIDATE_BATCH_MAX = 500 # ticket codes accepted per /api/validate_batch call
+SCANNER_TOKEN = os.environ.get("SCANPAYGO_SCANNER_TOKEN")   # shared X-Scanner-Token of the door scanners
+PAYMENT_STREAM_TIMEOUT = 30   # seconds an SSE stream stays open before the browser reconnects
+DB_NAME = os.environ.get("SCANPAYGO_DB", "tickets.db")
+SEARCH_CACHE_MAX = 2048                  # distinct (from, to, date) searches kept in memory
+ADMIN_TICKETS_PAGE = 100                 # rows per /admin/tickets page
+BOOKINGS_PAGE = 20                       # rows per /bookings page
+EXPORT_BATCH = 1000                      # rows fetched (and encoded) per chunk of an export
+IMPORT_MAX_ERRORS = 200                  # bad timetable rows listed back (all are counted)
+QR_CACHE_MAX_BYTES = 32 * 1024 * 1024   # encoded QR images kept in memory
+QR_MAX_AGE = 365 * 24 * 3600             # QR content never changes for a given URL
+QR_STORE_DIR = "qr_store"                # pre-generated QRs, named by content hash
+QR_PREGEN_HOURS = 24                     # default window of departures to pre-generate
+QR_PRUNE_GRACE_HOURS = 24                # stored QRs outlive their departure by this much
+QR_BASE_URL = "http://127.0.0.1:5000"    # host the QR URLs point at when built outside a request
 
 # ----------------------- DB HELPER ----------------------- #
 
+DB_BUSY_TIMEOUT_MS = 5000        # wait this long for a write lock before SQLITE_BUSY
+DB_STATEMENT_CACHE = 256         # prepared statements kept per connection
+DB_WRITE_RETRIES = 5             # attempts for a write that keeps hitting SQLITE_BUSY
+DB_RETRY_BASE_DELAY = 0.01       # seconds; doubled per attempt, with jitter
+
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+    """Open a new tuned connection. Routes should use get_db() instead."""
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
     conn.row_factory = sqlite3.Row
+    # WAL lets scanner reads run while a booking is writing
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
 
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_db():
+    """
+    Return the connection for the current request (or CLI command).
+    It is reused by every helper and closed on teardown, so don't close it yourself.
+    Background threads open their own with get_db_connection().
+    """
+    if "db" not in g:
+        g.db = get_db_connection()
+    return g.db
 
-    # Enable foreign keys
-    cur.execute("PRAGMA foreign_keys = ON")
 
+@app.teardown_appcontext
+def close_db(exc=None):
+    conn = g.pop("db", None)
+    if conn is not None:
+        conn.close()
+
+
+def run_write_transaction(conn, work):
+    """
+    Run work(conn) inside BEGIN IMMEDIATE and commit it.
+    The write lock is taken up front, so checks made inside work() still hold
+    at commit time. If the DB stays busy we retry with jittered backoff.
+    """
+    for attempt in range(DB_WRITE_RETRIES):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = work(conn)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            if "locked" not in str(e) or attempt == DB_WRITE_RETRIES - 1:
+                raise
+        except Exception:
+            conn.rollback()
+            raise
+        time.sleep(DB_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+# ----------------------- MIGRATIONS ----------------------- #
+# Each migration runs exactly once and is recorded in schema_version.
+# Append new ones to MIGRATIONS – never edit or reorder an applied one.
+
+def migrate_base_schema(cur):
     # USERS table
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -121,7 +204,7 @@ def init_db():
         )
     """)
 
-    # ---- MIGRATION for old DBs ----
+    # ---- old DBs created before the deposit / refund columns ----
     cur.execute("PRAGMA table_info(tickets)")
     existing_cols = {row[1] for row in cur.fetchall()}
 
@@ -147,6 +230,52 @@ def init_db():
           AND payment_status != 'PAID'
     """)
 
+
+def migrate_ticket_seats(cur):
+    # Seat inventory – one row per claimed seat, so a seat can only be sold once
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ticket_seats (
+            bus_id INTEGER NOT NULL,
+            seat_no INTEGER NOT NULL,
+            ticket_id INTEGER NOT NULL,
+            status TEXT NOT NULL,            -- mirrors tickets.payment_status
+            PRIMARY KEY (bus_id, seat_no),
+            FOREIGN KEY (bus_id) REFERENCES buses (id),
+            FOREIGN KEY (ticket_id) REFERENCES tickets (id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ticket_seats_ticket ON ticket_seats (ticket_id)")
+
+    # Backfill seat inventory from the old "1,2,3" strings
+    has_seats = cur.execute("SELECT 1 FROM ticket_seats LIMIT 1").fetchone()
+    if has_seats:
+        return
+    rows = cur.execute("""
+        SELECT t.id, t.bus_id, t.seat_numbers, t.payment_status
+        FROM tickets t
+        JOIN buses b ON t.bus_id = b.id
+        ORDER BY t.payment_status = 'PAID' DESC, t.id
+    """).fetchall()
+    seat_rows = []
+    for r in rows:
+        for seat_no in parse_seat_numbers(r["seat_numbers"]):
+            seat_rows.append((r["bus_id"], seat_no, r["id"], r["payment_status"]))
+    # PAID tickets come first, so they win if old data double-sold a seat
+    cur.executemany("""
+        INSERT OR IGNORE INTO ticket_seats (bus_id, seat_no, ticket_id, status)
+        VALUES (?, ?, ?, ?)
+    """, seat_rows)
+
+
+def migrate_search_indexes(cur):
+    # Secondary indexes for the hot access paths
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_buses_route ON buses (from_city, to_city, departure)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_buses_departure ON buses (departure)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_bus_status ON tickets (bus_id, payment_status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_booked_at ON tickets (booked_at)")
+
+
+def migrate_seed_buses(cur):
     # Seed buses if empty (your original seed)
     cur.execute("SELECT COUNT(*) AS c FROM buses")
     c = cur.fetchone()[0]
@@ -165,12 +294,188 @@ def init_db():
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, sample_buses)
 
+
+def migrate_payment_requests(cur):
+    # Results of wallet debits keyed by the scanner's idempotency token,
+    # so a retried scan gets the original answer instead of a second charge
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS payment_requests (
+            idempotency_key TEXT PRIMARY KEY,
+            ticket_code TEXT NOT NULL,
+            http_status INTEGER NOT NULL,
+            response TEXT NOT NULL,          -- JSON body we answered with
+            created_at TEXT NOT NULL
+        )
+    """)
+    # keys older than PAYMENT_REQUEST_TTL are pruned on every insert
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payment_requests_created ON payment_requests (created_at)")
+
+
+def migrate_catalog_version(cur):
+    # Single-row counter bumped by every write to buses, so each worker
+    # process can tell with one PK lookup whether its cached facets are stale
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    cur.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 1)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS buses_{event.lower()}_version
+            AFTER {event} ON buses
+            BEGIN
+                UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+            END
+        """)
+
+
+def migrate_bus_seat_counts(cur):
+    # Taken-seat counter per bus, kept in step with ticket_seats by triggers
+    # (+1 per claimed seat, -1 per released one), so occupancy is a PK read
+    # instead of a COUNT over the inventory
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bus_seat_counts (
+            bus_id INTEGER PRIMARY KEY,
+            booked INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (bus_id) REFERENCES buses (id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("DELETE FROM bus_seat_counts")
+    cur.execute("""
+        INSERT INTO bus_seat_counts (bus_id, booked)
+        SELECT bus_id, COUNT(*) FROM ticket_seats GROUP BY bus_id
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS ticket_seats_insert_count
+        AFTER INSERT ON ticket_seats
+        BEGIN
+            INSERT INTO bus_seat_counts (bus_id, booked) VALUES (NEW.bus_id, 1)
+            ON CONFLICT (bus_id) DO UPDATE SET booked = booked + 1;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS ticket_seats_delete_count
+        AFTER DELETE ON ticket_seats
+        BEGIN
+            UPDATE bus_seat_counts SET booked = booked - 1 WHERE bus_id = OLD.bus_id;
+        END
+    """)
+
+
+def migrate_admin_ticket_indexes(cur):
+    # Keyset pagination of /admin/tickets filtered by bus or status; the
+    # rowid (ticket id) is the implicit last column of each index
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_bus_booked ON tickets (bus_id, booked_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_status_booked ON tickets (payment_status, booked_at)")
+
+
+def find_duplicate_trips(conn):
+    """Groups of bus ids that share (operator, from_city, to_city, departure)."""
+    rows = conn.execute("""
+        SELECT group_concat(id) FROM buses
+        GROUP BY operator, from_city, to_city, departure
+        HAVING COUNT(*) > 1
+    """).fetchall()
+    return [[int(i) for i in r[0].split(",")] for r in rows]
+
+
+def ensure_trip_key(conn):
+    """
+    Create the unique trip index if it is missing.
+    Returns the duplicate groups that block it (empty once the index exists);
+    nothing is ever deleted here, an admin has to merge those trips.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_buses_trip'"
+    ).fetchone()
+    if exists:
+        return []
+    duplicates = find_duplicate_trips(conn)
+    if not duplicates:
+        conn.execute("""
+            CREATE UNIQUE INDEX idx_buses_trip
+            ON buses (operator, from_city, to_city, departure)
+        """)
+    return duplicates
+
+
+def migrate_bus_natural_key(cur):
+    # One trip per (operator, from, to, departure), so timetable imports can upsert.
+    # Old databases may already hold duplicates: they are reported, not
+    # deleted, and the index is created by the first import after they are merged.
+    duplicates = ensure_trip_key(cur)
+    if duplicates:
+        app.logger.warning(
+            "Duplicate trips (bus ids) %s: merge them in the admin dashboard; "
+            "timetable import is disabled until then.", duplicates
+        )
+
+
+def migrate_user_bookings_index(cur):
+    # "My bookings" is read by user, newest first (rowid breaks ties)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user_booked ON tickets (user_id, booked_at)")
+
+
+MIGRATIONS = [
+    (1, "base schema + legacy deposit/refund columns", migrate_base_schema),
+    (2, "ticket_seats inventory", migrate_ticket_seats),
+    (3, "search and sort indexes", migrate_search_indexes),
+    (4, "seed sample buses", migrate_seed_buses),
+    (5, "payment_requests idempotency log", migrate_payment_requests),
+    (6, "catalog version stamp on buses", migrate_catalog_version),
+    (7, "per-bus taken seat counters", migrate_bus_seat_counts),
+    (8, "admin ticket list indexes", migrate_admin_ticket_indexes),
+    (9, "unique trip key on buses", migrate_bus_natural_key),
+    (10, "tickets by user index", migrate_user_bookings_index),
+]
+
+
+def get_schema_version(conn):
+    """Return the highest applied migration (0 for a brand new DB)."""
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:   # no schema_version table yet
+        return 0
+    return row[0] or 0
+
+
+def init_db():
+    """Apply pending migrations. Up to date = a single SELECT, no writes."""
+    conn = get_db_connection()
+    latest = MIGRATIONS[-1][0]
+
+    if get_schema_version(conn) >= latest:
+        conn.close()
+        return
+
+    # Take the write lock, then re-check: another process may have migrated already
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    """)
+    current = get_schema_version(conn)
+    cur = conn.cursor()
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        migrate(cur)
+        cur.execute(
+            "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+            (version, description, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
     conn.commit()
     conn.close()
 
 # ----------------------- UTILS ----------------------- #
 
 def generate_ticket_code():
+    """Random legacy-style code, only used as a placeholder until the ticket id is known."""
     return "SPG-" + "".join(random.choices(string.ascii_uppercase + string.digits, k=8))
 
 
@@ -178,31 +483,201 @@ def generate_payment_id():
     return "PAY-" + "".join(random.choices(string.ascii_uppercase + string.digits, k=12))
 
 
-def get_booked_seats(bus_id):
-    """Return a set of seat numbers that are already booked (PAID tickets only)."""
-    conn = get_db_connection()
-    rows = conn.execute("""
-        SELECT seat_numbers FROM tickets
-        WHERE bus_id = ? AND payment_status = 'PAID'
-    """, (bus_id,)).fetchall()
-    conn.close()
+def parse_seat_numbers(seats_str):
+    """Parse a "1,2,3" seat string into a sorted list of unique ints."""
+    seats = set()
+    for s in (seats_str or "").split(","):
+        s = s.strip()
+        if s.isdigit():
+            seats.add(int(s))
+    return sorted(seats)
 
-    booked = set()
-    for r in rows:
-        seats_str = r["seat_numbers"]
-        if seats_str:
-            for s in seats_str.split(","):
-                s = s.strip()
-                if s.isdigit():
-                    booked.add(int(s))
-    return booked
 
+class SeatConflictError(Exception):
+    """Some of the requested seats were claimed by another booking."""
 
-def calculate_bus_occupancy(bus_row):
+    def __init__(self, seats):
+        super().__init__(f"Seats already taken: {seats}")
+        self.seats = seats
+
+
+class InvalidSeatsError(Exception):
+    """Some of the requested seats don't exist on the bus (outside 1..total_seats)."""
+
+    def __init__(self, seats):
+        super().__init__(f"No such seats: {seats}")
+        self.seats = seats
+
+
+class InsufficientBalanceError(Exception):
+    """Wallet balance is lower than the amount we tried to debit."""
+
+
+def claim_seats(conn, bus_id, ticket_id, seats, status="PENDING"):
+    """
+    Insert seat inventory rows for a ticket.
+    Raises sqlite3.IntegrityError if any seat is already taken on this bus.
+    """
+    conn.executemany("""
+        INSERT INTO ticket_seats (bus_id, seat_no, ticket_id, status)
+        VALUES (?, ?, ?, ?)
+    """, [(bus_id, s, ticket_id, status) for s in seats])
+
+
+def set_seats_status(conn, ticket_id, status):
+    """Keep ticket_seats.status in sync with tickets.payment_status."""
+    conn.execute(
+        "UPDATE ticket_seats SET status = ? WHERE ticket_id = ?",
+        (status, ticket_id)
+    )
+
+
+def release_seats(conn, ticket_id):
+    """Free every seat held by a ticket (ticket deleted / cancelled)."""
+    conn.execute("DELETE FROM ticket_seats WHERE ticket_id = ?", (ticket_id,))
+
+
+class SeatHolds:
+    """
+    Short-lived, in-memory seat reservations made while a user is picking seats.
+    Expiry order is kept in a min-heap, so dropping expired holds costs
+    O(log n) each instead of scanning every hold.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._holds = {}   # bus_id -> {seat_no: (user_id, expires_at)}
+        self._heap = []    # (expires_at, bus_id, seat_no)
+
+    def _expire(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, bus_id, seat_no = heapq.heappop(self._heap)
+            bus_holds = self._holds.get(bus_id, {})
+            hold = bus_holds.get(seat_no)
+            # skip heap entries for holds that were refreshed or released since
+            if hold and hold[1] == expires_at:
+                del bus_holds[seat_no]
+                if not bus_holds:
+                    del self._holds[bus_id]
+
+    def hold(self, bus_id, user_id, seats):
+        """
+        Make `seats` this user's held seats on the bus (replacing any older ones).
+        Returns the seats held by someone else; if non-empty, nothing changes.
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            bus_holds = self._holds.setdefault(bus_id, {})
+            conflicts = sorted(
+                s for s in seats
+                if s in bus_holds and bus_holds[s][0] != user_id
+            )
+            if conflicts:
+                return conflicts
+
+            for seat_no, (holder, _) in list(bus_holds.items()):
+                if holder == user_id and seat_no not in seats:
+                    del bus_holds[seat_no]
+
+            expires_at = now + self.ttl
+            for seat_no in seats:
+                bus_holds[seat_no] = (user_id, expires_at)
+                heapq.heappush(self._heap, (expires_at, bus_id, seat_no))
+            if not bus_holds:
+                del self._holds[bus_id]
+            return []
+
+    def release(self, bus_id, user_id):
+        """Drop every hold this user has on the bus (e.g. after booking)."""
+        with self._lock:
+            bus_holds = self._holds.get(bus_id, {})
+            for seat_no, (holder, _) in list(bus_holds.items()):
+                if holder == user_id:
+                    del bus_holds[seat_no]
+            if not bus_holds:
+                self._holds.pop(bus_id, None)
+
+    def held_by_others(self, bus_id, user_id=None):
+        """Set of seats on this bus held by anyone except `user_id`."""
+        with self._lock:
+            self._expire(time.time())
+            return {
+                seat_no
+                for seat_no, (holder, _) in self._holds.get(bus_id, {}).items()
+                if holder != user_id
+            }
+
+    def held_count(self, bus_id):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._holds.get(bus_id, {}))
+
+
+seat_holds = SeatHolds(SEAT_HOLD_TTL)
+
+
+class PaymentEvents:
+    """
+    In-process pub/sub for the PAID transition: every open payment stream
+    waits on its own queue, and a commit fans the event out to all of them
+    without any DB query per subscriber.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}   # ticket_id -> set of queues
+
+    def subscribe(self, ticket_id):
+        q = queue.SimpleQueue()
+        with self._lock:
+            self._waiters.setdefault(ticket_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, ticket_id, q):
+        with self._lock:
+            waiters = self._waiters.get(ticket_id)
+            if waiters:
+                waiters.discard(q)
+                if not waiters:
+                    del self._waiters[ticket_id]
+
+    def publish(self, ticket_id, data):
+        with self._lock:
+            waiters = list(self._waiters.get(ticket_id, ()))
+        for q in waiters:
+            q.put(data)
+
+
+payment_events = PaymentEvents()
+
+
+def publish_paid(ticket_id, ticket_code):
+    """Call after the PAID update has been committed."""
+    payment_events.publish(ticket_id, {"paid": True, "ticket_code": ticket_code})
+
+
+def get_booked_seats(bus_id, user_id=None):
+    """
+    Return a set of seat numbers that are not available: taken by a ticket
+    (deposit paid or fully PAID) or held by another user who is still picking.
+    """
+    conn = get_db()
+    rows = conn.execute(
+        "SELECT seat_no FROM ticket_seats WHERE bus_id = ?",
+        (bus_id,)
+    ).fetchall()
+
+    return {r["seat_no"] for r in rows} | seat_holds.held_by_others(bus_id, user_id)
+
+
+# SQLite's default limit on "?" parameters per statement is 999 on older builds
+SQL_PARAM_CHUNK = 500
+
+
+def occupancy_dict(booked, total_seats):
     """Return dict with booked_seats, available_seats, occupancy_percent."""
-    bus_id = bus_row["id"]
-    total_seats = bus_row["total_seats"]
-    booked = len(get_booked_seats(bus_id))
     available = max(total_seats - booked, 0)
     occ = (booked / total_seats * 100) if total_seats > 0 else 0
     return {
@@ -212,11 +687,804 @@ def calculate_bus_occupancy(bus_row):
     }
 
 
-# ----------------------- ROUTES ----------------------- #
+def get_booked_counts(conn, bus_ids):
+    """Return {bus_id: number of taken seats} from the trigger-maintained counters."""
+    counts = {}
+    bus_ids = list(bus_ids)
+    for i in range(0, len(bus_ids), SQL_PARAM_CHUNK):
+        chunk = bus_ids[i:i + SQL_PARAM_CHUNK]
+        placeholders = ",".join(["?"] * len(chunk))
+        rows = conn.execute(f"""
+            SELECT bus_id, booked FROM bus_seat_counts
+            WHERE bus_id IN ({placeholders})
+        """, chunk).fetchall()
+        for r in rows:
+            counts[r["bus_id"]] = r["booked"]
+    return counts
+
+
+def calculate_occupancy_batch(conn, bus_rows):
+    """Return {bus_id: occupancy dict} for many buses at once (no query per bus)."""
+    counts = get_booked_counts(conn, [b["id"] for b in bus_rows])
+    return {
+        b["id"]: occupancy_dict(
+            counts.get(b["id"], 0) + seat_holds.held_count(b["id"]),
+            b["total_seats"],
+        )
+        for b in bus_rows
+    }
+
+
+def calculate_bus_occupancy(bus_row):
+    """Return dict with booked_seats, available_seats, occupancy_percent."""
+    return calculate_occupancy_batch(get_db(), [bus_row])[bus_row["id"]]
+
+
+def create_booking(conn, bus, user, phone, seats_list,
+                   total_amount, deposit_amount, remaining_amount):
+    """
+    Atomically take the deposit, create the PENDING ticket and claim its seats.
+    Returns (ticket_id, ticket_code).
+    Raises InvalidSeatsError / SeatConflictError / InsufficientBalanceError
+    and changes nothing.
+    """
+    def work(conn):
+        # read inside the transaction: an admin may have just resized the bus
+        total_seats = conn.execute(
+            "SELECT total_seats FROM buses WHERE id = ?", (bus["id"],)
+        ).fetchone()["total_seats"]
+        invalid = [s for s in seats_list if s < 1 or s > total_seats]
+        if invalid:
+            raise InvalidSeatsError(invalid)
+
+        placeholders = ",".join(["?"] * len(seats_list))
+        taken = conn.execute(f"""
+            SELECT seat_no FROM ticket_seats
+            WHERE bus_id = ? AND seat_no IN ({placeholders})
+        """, [bus["id"], *seats_list]).fetchall()
+        if taken:
+            raise SeatConflictError(sorted(r["seat_no"] for r in taken))
+
+        held = seat_holds.held_by_others(bus["id"], user["id"]) & set(seats_list)
+        if held:
+            raise SeatConflictError(sorted(held))
+
+        # Deduct deposit from wallet now (guarded, so the balance can't go negative)
+        cur = conn.execute(
+            "UPDATE users SET wallet_balance = wallet_balance - ? WHERE id = ? AND wallet_balance >= ?",
+            (deposit_amount, user["id"], deposit_amount),
+        )
+        if cur.rowcount == 0:
+            raise InsufficientBalanceError()
+
+        ticket_code = generate_ticket_code()
+        booked_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        seats_str = ",".join(str(s) for s in seats_list)
+
+        # Create ticket with deposit + remaining
+        cur.execute(
+            """
+            INSERT INTO tickets (
+                ticket_code,
+                bus_id,
+                user_id,
+                passenger_name,
+                passenger_email,
+                passenger_phone,
+                seat_numbers,
+                quantity,
+                total_amount,
+                deposit_amount,
+                remaining_amount,
+                payment_status,
+                booked_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                ticket_code,
+                bus["id"],
+                user["id"],
+                user["name"],
+                user["email"],
+                phone,
+                seats_str,
+                len(seats_list),
+                total_amount,
+                deposit_amount,
+                remaining_amount,
+                "PENDING",   # will be fully paid on scan / NFC
+                booked_at,
+            ),
+        )
+        ticket_id = cur.lastrowid
+
+        # Swap the placeholder for the signed SPG-<id>-<bus>-<nonce>-<tag> code
+        ticket_code = sign_ticket_code(ticket_id, bus["id"])
+        cur.execute("UPDATE tickets SET ticket_code = ? WHERE id = ?", (ticket_code, ticket_id))
+
+        # The (bus_id, seat_no) key is the final guard against a double sale
+        try:
+            claim_seats(conn, bus["id"], ticket_id, seats_list)
+        except sqlite3.IntegrityError:
+            raise SeatConflictError(seats_list)
+        return ticket_id, ticket_code
+
+    result = run_write_transaction(conn, work)
+    seat_holds.release(bus["id"], user["id"])
+    forget_current_user()
+    return result
 
-# folder for NFC payment QRs
-NFC_QR_FOLDER = os.path.join("static", "nfc_qr")
-os.makedirs(NFC_QR_FOLDER, exist_ok=True)
+
+def get_payment_request(conn, idempotency_key, ticket_code):
+    """
+    Return the stored (data, status) for an already-processed key, or None.
+    A key that was used for a different ticket gets a 409 instead: the stored
+    answer belongs to that other ticket and must never be replayed.
+    """
+    row = conn.execute(
+        "SELECT ticket_code, http_status, response FROM payment_requests WHERE idempotency_key = ?",
+        (idempotency_key,)
+    ).fetchone()
+    if not row:
+        return None
+    if row["ticket_code"] != ticket_code:
+        return {"success": False, "reason": "idempotency_key_reused"}, 409
+    return json.loads(row["response"]), row["http_status"]
+
+
+def charge_wallet(conn, ticket_code, idempotency_key=None):
+    """
+    Deduct the ticket's remaining fare from its owner's wallet and mark it PAID.
+    Returns (data, status) for jsonify. The debit is a guarded UPDATE inside one
+    short IMMEDIATE transaction, so two scanners can never both charge a ticket.
+    """
+    if idempotency_key:
+        stored = get_payment_request(conn, idempotency_key, ticket_code)
+        if stored:
+            return stored
+
+    if not verify_ticket_code(ticket_code):
+        return {"success": False, "reason": "Ticket not found"}, 404
+
+    paid_ids = []   # ticket charged by the attempt that committed
+
+    def work(conn):
+        paid_ids.clear()
+
+        # re-check under the write lock: an identical retry may have just finished
+        if idempotency_key:
+            stored = get_payment_request(conn, idempotency_key, ticket_code)
+            if stored:
+                return stored
+
+        ticket = conn.execute(
+            "SELECT id, user_id, payment_status, remaining_amount FROM tickets WHERE ticket_code = ?",
+            (ticket_code,)
+        ).fetchone()
+
+        if not ticket:
+            return {"success": False, "reason": "Ticket not found"}, 404
+
+        # If already paid, nothing to do
+        if ticket["payment_status"] == "PAID":
+            return {"success": True, "paid": True}, 200
+
+        remaining = float(ticket["remaining_amount"] or 0.0)
+
+        # In case of old tickets or weird data, fall back
+        if remaining <= 0:
+            # treat as already paid
+            return {"success": True, "paid": True, "info": "no_remaining_amount"}, 200
+
+        # Deduct remaining from user's wallet only if the balance covers it
+        cur = conn.execute(
+            "UPDATE users SET wallet_balance = wallet_balance - ? WHERE id = ? AND wallet_balance >= ?",
+            (remaining, ticket["user_id"], remaining)
+        )
+        if cur.rowcount == 0:
+            return {"success": False, "reason": "Insufficient Wallet Balance"}, 400
+
+        conn.execute(
+            """
+            UPDATE tickets
+            SET payment_status = 'PAID',
+                payment_id = ?,
+                remaining_amount = 0
+            WHERE id = ? AND payment_status != 'PAID'
+            """,
+            (generate_payment_id(), ticket["id"])
+        )
+        set_seats_status(conn, ticket["id"], "PAID")
+        paid_ids.append(ticket["id"])
+
+        data = {
+            "success": True,
+            "ticket_code": ticket_code,
+            "status": "PAID",
+            "deducted_amount": remaining
+        }
+        if idempotency_key:
+            now = datetime.now()
+            # the scanner sends a fresh key per scan: forget those past any retry window
+            conn.execute(
+                "DELETE FROM payment_requests WHERE created_at < ?",
+                ((now - timedelta(seconds=PAYMENT_REQUEST_TTL)).strftime("%Y-%m-%d %H:%M:%S"),)
+            )
+            conn.execute("""
+                INSERT INTO payment_requests (idempotency_key, ticket_code, http_status, response, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (idempotency_key, ticket_code, 200, json.dumps(data),
+                  now.strftime("%Y-%m-%d %H:%M:%S")))
+        return data, 200
+
+    result = run_write_transaction(conn, work)
+    for ticket_id in paid_ids:
+        publish_paid(ticket_id, ticket_code)
+    if paid_ids:
+        forget_current_user()
+    return result
+
+
+class KeysetPage:
+    """
+    Iterates at most `size` rows straight off a cursor fetched with LIMIT size + 1.
+    Once iterated, `has_more` and `last` give the cursor for the next page.
+    `conn` (if given) is closed when iteration ends.
+    """
+
+    def __init__(self, cursor, size, conn=None):
+        self._cursor = cursor
+        self._conn = conn
+        self.size = size
+        self.count = 0
+        self.last = None
+        self.has_more = False
+
+    def __iter__(self):
+        try:
+            for row in self._cursor:
+                if self.count == self.size:
+                    self.has_more = True
+                    break
+                self.count += 1
+                self.last = row
+                yield row
+        finally:
+            if self._conn is not None:
+                self._conn.close()
+
+
+def get_ticket_filters():
+    """Admin ticket filters from the query string; only the ones actually set."""
+    filters = {
+        "bus_id": request.args.get("bus_id", type=int),
+        "status": request.args.get("status", "").strip().upper(),
+        "date_from": request.args.get("date_from", "").strip(),
+        "date_to": request.args.get("date_to", "").strip(),
+    }
+    return {k: v for k, v in filters.items() if v}
+
+
+def ticket_filter_sql(filters):
+    """Return (" AND ..." clause, params) for tickets aliased as t."""
+    sql = ""
+    params = []
+    if "bus_id" in filters:
+        sql += " AND t.bus_id = ?"
+        params.append(filters["bus_id"])
+    if "status" in filters:
+        sql += " AND t.payment_status = ?"
+        params.append(filters["status"])
+    if "date_from" in filters:
+        sql += " AND t.booked_at >= ?"
+        params.append(filters["date_from"])
+    if "date_to" in filters:
+        sql += " AND t.booked_at < date(?, '+1 day')"
+        params.append(filters["date_to"])
+    return sql, params
+
+
+def get_idempotency_key():
+    """Scanner's retry token, from the Idempotency-Key header or the JSON body."""
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        payload = request.get_json(silent=True)
+        key = payload.get("idempotency_key") if isinstance(payload, dict) else None
+    return key if isinstance(key, str) and key else None
+
+
+def wants_json():
+    """True when the client asked for a JSON answer instead of an HTML page."""
+    return request.is_json or request.accept_mimetypes.best == "application/json"
+
+
+def get_current_user():
+    """
+    The logged-in user's row, loaded at most once per request.
+    Route handlers and the navbar context processor share it.
+    """
+    if "current_user" not in g:
+        user_id = session.get("user_id")
+        # never the password column: this row is handed to every template
+        g.current_user = get_db().execute(
+            "SELECT id, name, email, wallet_balance FROM users WHERE id = ?", (user_id,)
+        ).fetchone() if user_id else None
+    return g.current_user
+
+
+def forget_current_user():
+    """Drop the cached row after a commit that changed a wallet balance."""
+    if has_app_context():
+        g.pop("current_user", None)
+
+
+# ----------------------- SEARCH FACETS ----------------------- #
+
+def get_catalog_version(conn):
+    """Current buses version stamp (bumped by triggers on every bus write)."""
+    return conn.execute("SELECT version FROM catalog_version WHERE id = 1").fetchone()[0]
+
+
+class BusFacets:
+    """
+    City list, valid routes and the date span of each route, built from
+    buses in one GROUP BY and reused until the catalog version moves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._facets = None
+
+    def get(self, conn):
+        version = get_catalog_version(conn)
+        with self._lock:
+            if self._version == version:
+                return self._facets
+
+        # built after reading the stamp, so the data is never older than it
+        facets = self._build(conn, version)
+        with self._lock:
+            self._version, self._facets = version, facets
+        return facets
+
+    def invalidate(self):
+        with self._lock:
+            self._version = self._facets = None
+
+    @staticmethod
+    def _build(conn, version):
+        rows = conn.execute("""
+            SELECT from_city, to_city,
+                   MIN(date(departure)) AS first_day,
+                   MAX(date(departure)) AS last_day,
+                   COUNT(*) AS buses
+            FROM buses
+            GROUP BY from_city, to_city
+        """).fetchall()
+
+        cities = set()
+        routes = []
+        for r in rows:
+            cities.update((r["from_city"], r["to_city"]))
+            routes.append({
+                "from_city": r["from_city"],
+                "to_city": r["to_city"],
+                "first_day": r["first_day"],
+                "last_day": r["last_day"],
+                "buses": r["buses"],
+            })
+        return {"version": version, "cities": sorted(cities), "routes": routes}
+
+
+bus_facets = BusFacets()
+
+
+class SearchCache:
+    """
+    LRU of bus rows per normalized (from, to, date) search.
+    Entries are dropped wholesale when the catalog version moves; occupancy
+    is never cached here, it is read fresh from bus_seat_counts.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._version = None
+
+    def get(self, conn, key, load):
+        version = get_catalog_version(conn)
+        with self._lock:
+            if version != self._version:
+                self._items.clear()
+                self._version = version
+            rows = self._items.get(key)
+            if rows is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return rows
+            self.misses += 1
+
+        rows = load()
+        with self._lock:
+            if self._version == version:
+                self._items[key] = rows
+                while len(self._items) > self.max_entries:
+                    self._items.popitem(last=False)
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._items),
+                "catalog_version": self._version,
+            }
+
+
+search_cache = SearchCache(SEARCH_CACHE_MAX)
+
+
+# ----------------------- QR IMAGES ----------------------- #
+
+class QRCache:
+    """Size-bounded LRU of encoded QR images: (content, fmt) -> (bytes, etag)."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def put(self, key, data):
+        item = (data, hashlib.sha256(data).hexdigest()[:32])
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._items[key] = item
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self._items) > 1:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self.size -= len(evicted)
+        return item
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self.size}
+
+
+qr_cache = QRCache(QR_CACHE_MAX_BYTES)
+
+QR_MIMETYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def render_qr(content, fmt):
+    """Encode `content` as a QR image and return the file bytes."""
+    if fmt == "svg":
+        img = qrcode.make(content, image_factory=qrcode.image.svg.SvgPathImage)
+    else:
+        img = qrcode.make(content)
+    buf = io.BytesIO()
+    img.save(buf)
+    return buf.getvalue()
+
+
+def qr_store_path(content, fmt):
+    """Content-addressed location of a pre-generated QR in QR_STORE_DIR."""
+    digest = hashlib.sha256(f"{fmt}:{content}".encode()).hexdigest()
+    return os.path.join(QR_STORE_DIR, digest[:2], f"{digest}.{fmt}")
+
+
+def store_qr(job):
+    """
+    Process-pool worker: render one QR and write it atomically
+    (temp file + os.replace), so readers never see a half-written image.
+    """
+    content, fmt, path = job
+    data = render_qr(content, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_qr(content, fmt):
+    """QR bytes from the pre-generated store, or a fresh render."""
+    try:
+        with open(qr_store_path(content, fmt), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return render_qr(content, fmt)
+
+
+def qr_response(content, fmt, exists):
+    """
+    Serve a QR from the LRU (store / render on a miss) with a strong ETag.
+    exists() is only asked on a miss, so unknown tickets get a 404 without
+    anything being rendered or cached, and cached QRs cost no query.
+    """
+    key = (content, fmt)
+    item = qr_cache.get(key)
+    if item is None:
+        if not exists():
+            return "Ticket not found", 404
+        item = qr_cache.put(key, load_qr(content, fmt))
+    data, etag = item
+
+    resp = app.response_class(data, mimetype=QR_MIMETYPES[fmt])
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={QR_MAX_AGE}, immutable"
+    return resp.make_conditional(request)
+
+
+@app.route("/qr/<ticket_code>.<any(png, svg):fmt>")
+def ticket_qr(ticket_code, fmt):
+    """Ticket QR – encodes the ticket URL so a phone scan opens the ticket page."""
+    if not verify_ticket_code(ticket_code):
+        return "Ticket not found", 404
+    # a valid signature doesn't prove the ticket exists (and legacy codes carry none)
+    return qr_response(
+        url_for("ticket", ticket_code=ticket_code, _external=True), fmt,
+        lambda: get_db().execute(
+            "SELECT 1 FROM tickets WHERE ticket_code = ?", (ticket_code,)
+        ).fetchone() is not None,
+    )
+
+
+@app.route("/qr/nfc/<int:ticket_id>.<any(png, svg):fmt>")
+def nfc_qr_image(ticket_id, fmt):
+    """NFC payment QR – encodes the phone-side payment URL."""
+    return qr_response(
+        url_for("nfc_pay", ticket_id=ticket_id, _external=True), fmt,
+        lambda: get_db().execute(
+            "SELECT 1 FROM tickets WHERE id = ?", (ticket_id,)
+        ).fetchone() is not None,
+    )
+
+
+# Held while a pre-generation runs, so the admin button can't start a second one
+qr_pregen_lock = threading.Lock()
+
+
+def ticket_qr_contents(rows):
+    """The ticket and NFC URLs the /qr routes encode, for rows with id + ticket_code."""
+    for r in rows:
+        yield url_for("ticket", ticket_code=r["ticket_code"], _external=True)
+        yield url_for("nfc_pay", ticket_id=r["id"], _external=True)
+
+
+def prune_qr_store(grace_hours=QR_PRUNE_GRACE_HOURS, base_url=QR_BASE_URL):
+    """
+    Delete stored QRs that no longer belong to a live ticket on a bus departing
+    after now - grace_hours. Returns how many files were removed.
+    """
+    if not os.path.isdir(QR_STORE_DIR):
+        return 0
+    since = (datetime.now() - timedelta(hours=grace_hours)).strftime("%Y-%m-%d %H:%M")
+    conn = get_db_connection()
+    rows = conn.execute("""
+        SELECT t.id, t.ticket_code
+        FROM buses b
+        JOIN tickets t ON t.bus_id = b.id
+        WHERE b.departure >= ?
+          AND t.payment_status IN ('PENDING', 'PAID')
+    """, (since,)).fetchall()
+    conn.close()
+
+    with app.test_request_context(base_url=base_url):
+        keep = {
+            qr_store_path(content, fmt)
+            for content in ticket_qr_contents(rows)
+            for fmt in QR_MIMETYPES
+        }
+
+    pruned = 0
+    for dirpath, _, filenames in os.walk(QR_STORE_DIR):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            # *.tmp files are a worker's write in progress
+            if path.endswith(".tmp") or path in keep:
+                continue
+            try:
+                os.remove(path)
+                pruned += 1
+            except FileNotFoundError:
+                pass
+    return pruned
+
+
+def pregenerate_qrs(hours=QR_PREGEN_HOURS, workers=None, base_url=QR_BASE_URL):
+    """
+    Render ticket + NFC QRs for every ticket on buses departing in the next
+    `hours`, in a process pool, into QR_STORE_DIR. QRs already in the store
+    are skipped, and QRs of past departures are pruned.
+    Returns a stats dict (tickets, rendered, skipped, pruned, seconds, per_second).
+    """
+    started = time.perf_counter()
+    now = datetime.now()
+    conn = get_db_connection()
+    rows = conn.execute("""
+        SELECT t.id, t.ticket_code
+        FROM buses b
+        JOIN tickets t ON t.bus_id = b.id
+        WHERE b.departure >= ? AND b.departure < ?
+          AND t.payment_status IN ('PENDING', 'PAID')
+    """, (now.strftime("%Y-%m-%d %H:%M"), (now + timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M"))).fetchall()
+    conn.close()
+
+    # same URLs the /qr routes encode, so the content hashes match
+    jobs = []
+    skipped = 0
+    with app.test_request_context(base_url=base_url):
+        for content in ticket_qr_contents(rows):
+            path = qr_store_path(content, "png")
+            if os.path.exists(path):
+                skipped += 1
+            else:
+                jobs.append((content, "png", path))
+
+    if jobs:
+        # spawn, not fork: the server has other threads (and their locks) we must not copy
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            for _ in pool.map(store_qr, jobs, chunksize=16):
+                pass
+
+    pruned = prune_qr_store(base_url=base_url)
+
+    seconds = time.perf_counter() - started
+    return {
+        "tickets": len(rows),
+        "rendered": len(jobs),
+        "skipped": skipped,
+        "pruned": pruned,
+        "seconds": round(seconds, 2),
+        "per_second": round(len(rows) / seconds, 1) if seconds > 0 else 0.0,
+    }
+
+
+@app.cli.command("pregen-qr")
+@click.option("--hours", default=QR_PREGEN_HOURS, show_default=True, help="Departure window to cover.")
+@click.option("--workers", default=None, type=int, help="Worker processes (default: CPU count).")
+@click.option("--base-url", default=QR_BASE_URL, show_default=True, help="Host the QR URLs point at.")
+def pregen_qr_command(hours, workers, base_url):
+    """Pre-generate QRs for upcoming departures: flask --app app pregen-qr"""
+    stats = pregenerate_qrs(hours, workers, base_url)
+    click.echo(
+        f"{stats['tickets']} tickets: {stats['rendered']} QRs rendered, "
+        f"{stats['skipped']} already stored, {stats['pruned']} pruned, {stats['seconds']}s "
+        f"({stats['per_second']} tickets/s)"
+    )
+
+
+# ----------------------- TIMETABLE IMPORT ----------------------- #
+
+TIMETABLE_COLUMNS = ["operator", "from_city", "to_city", "departure", "arrival",
+                     "price", "total_seats", "bus_type"]
+
+
+def parse_timetable_row(row):
+    """Return the buses tuple for one CSV row, or raise ValueError with the reason."""
+    if len(row) != len(TIMETABLE_COLUMNS):
+        raise ValueError(f"expected {len(TIMETABLE_COLUMNS)} columns, got {len(row)}")
+    operator, from_city, to_city, departure, arrival, price, total_seats, bus_type = (
+        v.strip() for v in row
+    )
+    if not all([operator, from_city, to_city, departure, arrival, bus_type]):
+        raise ValueError("empty field")
+    if from_city == to_city:
+        raise ValueError("from_city and to_city are the same")
+
+    # same "YYYY-MM-DD HH:MM" text the admin form stores
+    dep = datetime.fromisoformat(departure.replace("T", " ")).strftime("%Y-%m-%d %H:%M")
+    arr = datetime.fromisoformat(arrival.replace("T", " ")).strftime("%Y-%m-%d %H:%M")
+    if arr <= dep:
+        raise ValueError("arrival is not after departure")
+
+    price = float(price)
+    total_seats = int(total_seats)
+    if not math.isfinite(price):
+        raise ValueError("price must be a finite number")
+    if price < 0 or total_seats < 1:
+        raise ValueError("price must be >= 0 and total_seats >= 1")
+    return (operator, from_city, to_city, dep, arr, price, total_seats, bus_type)
+
+
+class DuplicateTripsError(Exception):
+    """Existing buses share a trip key, so imported rows can't be upserted yet."""
+
+    def __init__(self, groups):
+        super().__init__(f"duplicate trips (bus ids): {groups}")
+        self.groups = groups
+
+
+def import_timetable(conn, lines):
+    """
+    Load buses from CSV text lines (header row optional, columns as in
+    TIMETABLE_COLUMNS). Good rows are upserted on (operator, from_city,
+    to_city, departure) with one executemany in a single transaction;
+    bad rows are skipped and reported with their line number.
+    Raises DuplicateTripsError if existing buses still need merging.
+    """
+    rows = []
+    errors = []
+    error_count = 0
+
+    for line_no, row in enumerate(csv.reader(lines), start=1):
+        if not row or not any(v.strip() for v in row):
+            continue
+        if line_no == 1 and row[0].strip().lower() == "operator":
+            continue
+        try:
+            rows.append(parse_timetable_row(row))
+        except ValueError as e:
+            error_count += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_no, "error": str(e)})
+
+    def work(conn):
+        duplicates = ensure_trip_key(conn)
+        if duplicates:
+            raise DuplicateTripsError(duplicates)
+        before = conn.execute("SELECT COUNT(*) FROM buses").fetchone()[0]
+        conn.executemany("""
+            INSERT INTO buses (operator, from_city, to_city, departure, arrival,
+                               price, total_seats, bus_type)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (operator, from_city, to_city, departure) DO UPDATE SET
+                arrival = excluded.arrival,
+                price = excluded.price,
+                total_seats = excluded.total_seats,
+                bus_type = excluded.bus_type
+        """, rows)
+        after = conn.execute("SELECT COUNT(*) FROM buses").fetchone()[0]
+        return after - before
+
+    inserted = run_write_transaction(conn, work) if rows else 0
+    bus_facets.invalidate()
+    return {
+        "rows": len(rows),
+        "inserted": inserted,
+        "updated": len(rows) - inserted,
+        "error_count": error_count,
+        "errors": errors,
+    }
+
+
+@app.cli.command("import-buses")
+@click.argument("csv_file", type=click.File("r", encoding="utf-8-sig"))
+def import_buses_command(csv_file):
+    """Bulk load a timetable CSV: flask --app app import-buses trips.csv"""
+    started = time.perf_counter()
+    try:
+        result = import_timetable(get_db(), csv_file)
+    except DuplicateTripsError as e:
+        raise click.ClickException(f"{e}; merge or delete them before importing.")
+    click.echo(
+        f"{result['rows']} rows: {result['inserted']} inserted, {result['updated']} updated, "
+        f"{result['error_count']} rejected ({time.perf_counter() - started:.2f}s)"
+    )
+    for e in result["errors"]:
+        click.echo(f"  line {e['line']}: {e['error']}")
+
+
+# ----------------------- ROUTES ----------------------- #
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -229,7 +1497,7 @@ def register():
             flash("Please fill all fields.", "danger")
             return render_template("register.html")
 
-        conn = get_db_connection()
+        conn = get_db()
         cur = conn.cursor()
         try:
             cur.execute("""
@@ -238,12 +1506,10 @@ def register():
             """, (name, email, password, 2000.0))
             conn.commit()
         except sqlite3.IntegrityError:
-            conn.close()
             flash("Email already registered.", "danger")
             return render_template("register.html")
 
         user_id = cur.lastrowid
-        conn.close()
 
         session["user_id"] = user_id
         session["user_name"] = name
@@ -259,11 +1525,10 @@ def login():
         email = request.form.get("email", "").strip()
         password = request.form.get("password", "").strip()
 
-        conn = get_db_connection()
+        conn = get_db()
         user = conn.execute("""
             SELECT * FROM users WHERE email = ? AND password = ?
         """, (email, password)).fetchone()
-        conn.close()
 
         if not user:
             flash("Invalid email or password.", "danger")
@@ -271,6 +1536,7 @@ def login():
 
         session["user_id"] = user["id"]
         session["user_name"] = user["name"]
+        session.pop("ticket_codes", None)   # left over from before bookings were per user
         flash("Logged in successfully.", "success")
         return redirect(url_for("home"))
 
@@ -288,45 +1554,35 @@ def nfc_qr(ticket_id):
     """
     Laptop-side page:
     - shows a QR that encodes the mobile payment URL
-    - polls backend to know when payment is completed
+    - listens on /api/payment_stream for the payment (polls
+      /api/payment_status only where EventSource is missing)
     """
-    conn = get_db_connection()
+    conn = get_db()
     ticket = conn.execute("""
         SELECT t.*, b.operator, b.from_city, b.to_city, b.departure, b.arrival
         FROM tickets t
         JOIN buses b ON t.bus_id = b.id
         WHERE t.id = ?
     """, (ticket_id,)).fetchone()
-    conn.close()
 
     if not ticket:
         flash("Ticket not found.", "danger")
         return redirect(url_for("home"))
 
-    # full mobile URL (phone opens this)
-    pay_url = url_for("nfc_pay", ticket_id=ticket_id, _external=True)
-
-    # generate / reuse QR image
-    qr_filename = f"nfc_qr_{ticket_id}.png"
-    qr_path = os.path.join(NFC_QR_FOLDER, qr_filename)
-    if not os.path.exists(qr_path):
-        img = qrcode.make(pay_url)
-        img.save(qr_path)
-
+    # QR encodes the full mobile URL (phone opens this); served from the QR cache
     return render_template(
         "nfc_qr.html",
         ticket=ticket,
-        qr_filename=f"nfc_qr/{qr_filename}",
+        qr_url=url_for("nfc_qr_image", ticket_id=ticket_id, fmt="png"),
     )
 @app.route("/api/payment_status/<int:ticket_id>")
 def payment_status(ticket_id):
     """Return simple JSON: is this ticket paid yet? (for polling from laptop QR page)."""
-    conn = get_db_connection()
+    conn = get_db()
     row = conn.execute(
         "SELECT payment_status, ticket_code FROM tickets WHERE id = ?",
         (ticket_id,)
     ).fetchone()
-    conn.close()
 
     if not row:
         return jsonify({"exists": False}), 404
@@ -336,6 +1592,44 @@ def payment_status(ticket_id):
         "paid": row["payment_status"] == "PAID",
         "ticket_code": row["ticket_code"],
     })
+@app.route("/api/payment_stream/<int:ticket_id>")
+def payment_stream(ticket_id):
+    """
+    Server-Sent Events for the laptop QR page: one 'paid' event as soon as
+    any payment path commits. The stream closes after PAYMENT_STREAM_TIMEOUT
+    and EventSource reconnects, which re-checks the DB once.
+
+    Each open page holds a worker thread while it waits, so serve the app
+    with a threaded or async worker (see README), never a few sync workers.
+    """
+    # subscribe before the DB check, so a payment in between isn't missed
+    events = payment_events.subscribe(ticket_id)
+    row = get_db().execute(
+        "SELECT payment_status, ticket_code FROM tickets WHERE id = ?",
+        (ticket_id,)
+    ).fetchone()
+
+    if not row:
+        payment_events.unsubscribe(ticket_id, events)
+        return jsonify({"exists": False}), 404
+
+    def stream():
+        try:
+            yield "retry: 1000\n\n"
+            if row["payment_status"] == "PAID":
+                data = {"paid": True, "ticket_code": row["ticket_code"]}
+            else:
+                try:
+                    data = events.get(timeout=PAYMENT_STREAM_TIMEOUT)
+                except queue.Empty:
+                    return
+            yield f"event: paid\ndata: {json.dumps(data)}\n\n"
+        finally:
+            payment_events.unsubscribe(ticket_id, events)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/nfc_pay/<int:ticket_id>", methods=["GET", "POST"])
 def nfc_pay(ticket_id):
     """
@@ -343,7 +1637,7 @@ def nfc_pay(ticket_id):
     - shows trip summary and a big 'Pay with NFC' button
     - POST marks ticket as PAID
     """
-    conn = get_db_connection()
+    conn = get_db()
     ticket = conn.execute("""
         SELECT t.*, b.operator, b.from_city, b.to_city, b.departure, b.arrival
         FROM tickets t
@@ -352,7 +1646,6 @@ def nfc_pay(ticket_id):
     """, (ticket_id,)).fetchone()
 
     if not ticket:
-        conn.close()
         return "Ticket not found", 404
 
     if request.method == "POST":
@@ -364,13 +1657,13 @@ def nfc_pay(ticket_id):
                 SET payment_status = ?, payment_id = ?
                 WHERE id = ?
             """, ("PAID", payment_id, ticket_id))
+            set_seats_status(conn, ticket_id, "PAID")
             conn.commit()
+            publish_paid(ticket_id, ticket["ticket_code"])
 
-        conn.close()
         # Show simple success page
         return render_template("nfc_pay.html", ticket=ticket, paid=True)
 
-    conn.close()
     # GET – show pay button
     return render_template("nfc_pay.html", ticket=ticket, paid=(ticket["payment_status"] == "PAID"))
 
@@ -401,16 +1694,7 @@ def admin_logout():
 @app.route("/", methods=["GET", "POST"])
 def home():
     """Home page with search form."""
-    conn = get_db_connection()
-    cities = conn.execute("""
-        SELECT DISTINCT from_city AS city FROM buses
-        UNION
-        SELECT DISTINCT to_city AS city FROM buses
-    """).fetchall()
-    conn.close()
-
-    # each row has key "city"
-    city_list = sorted({c["city"] for c in cities})
+    city_list = bus_facets.get(get_db())["cities"]
 
     # Handle quick search redirect
     if request.method == "POST":
@@ -427,6 +1711,22 @@ def home():
 
     return render_template("home.html", cities=city_list)
 
+@app.route("/api/facets")
+def api_facets():
+    """Cities, routes and route date spans for search UIs; ETag is the catalog version."""
+    facets = bus_facets.get(get_db())
+    resp = jsonify(facets)
+    resp.set_etag(f"catalog-{facets['version']}")
+    return resp.make_conditional(request)
+
+@app.route("/api/cache_stats")
+def api_cache_stats():
+    """Hit/miss counters of the in-process caches, for scraping."""
+    return jsonify({
+        "search": search_cache.stats(),
+        "qr": qr_cache.stats(),
+    })
+
 @app.route("/buses")
 def buses():
     """List buses that match search criteria + show occupancy."""
@@ -444,17 +1744,20 @@ def buses():
         query += " AND to_city = ?"
         params.append(to_city)
     if travel_date:
-        # match date part of departure
-        query += " AND date(departure) = ?"
-        params.append(travel_date)
-
-    conn = get_db_connection()
-    buses_rows = conn.execute(query, params).fetchall()
-    conn.close()
+        # match date part of departure as a range, so idx_buses_route can be used
+        query += " AND departure >= ? AND departure < date(?, '+1 day')"
+        params.extend([travel_date, travel_date])
+
+    conn = get_db()
+    buses_rows = search_cache.get(
+        conn, (from_city, to_city, travel_date),
+        lambda: [dict(r) for r in conn.execute(query, params)],
+    )
+    occupancy = calculate_occupancy_batch(conn, buses_rows)
 
     buses_list = []
     for b in buses_rows:
-        occ = calculate_bus_occupancy(b)
+        occ = occupancy[b["id"]]
         buses_list.append({
             "id": b["id"],
             "operator": b["operator"],
@@ -478,64 +1781,9 @@ def buses():
 
 @app.route("/api/wallet_pay/<ticket_code>", methods=["POST"])
 def wallet_pay(ticket_code):
-    conn = get_db_connection()
-
-    # Load ticket + its owner + their wallet balance
-    ticket = conn.execute("""
-        SELECT t.*, u.wallet_balance, u.id AS user_id
-        FROM tickets t
-        JOIN users u ON t.user_id = u.id
-        WHERE t.ticket_code = ?
-    """, (ticket_code,)).fetchone()
-
-    if not ticket:
-        conn.close()
-        return jsonify({"success": False, "reason": "Ticket not found"}), 404
-
-    # If already paid, nothing to do
-    if ticket["payment_status"] == "PAID":
-        conn.close()
-        return jsonify({"success": True, "paid": True}), 200
-
-    remaining = float(ticket["remaining_amount"] or 0.0)
-
-    # In case of old tickets or weird data, fall back
-    if remaining <= 0:
-        # treat as already paid
-        conn.close()
-        return jsonify({"success": True, "paid": True, "info": "no_remaining_amount"}), 200
-
-    balance = float(ticket["wallet_balance"])
-
-    if balance < remaining:
-        conn.close()
-        return jsonify({"success": False, "reason": "Insufficient Wallet Balance"}), 400
-
-    # Deduct remaining from user's wallet and mark ticket as PAID
-    conn.execute(
-        "UPDATE users SET wallet_balance = wallet_balance - ? WHERE id = ?",
-        (remaining, ticket["user_id"])
-    )
-    conn.execute(
-        """
-        UPDATE tickets
-        SET payment_status = 'PAID',
-            payment_id = ?,
-            remaining_amount = 0
-        WHERE ticket_code = ?
-        """,
-        (generate_payment_id(), ticket_code)
-    )
-
-    conn.commit()
-    conn.close()
-
-    return jsonify({
-        "success": True,
-        "ticket_code": ticket_code,
-        "status": "PAID",
-        "deducted_amount": remaining
-    }), 200
+    """Charge the remaining fare on scan. Send an Idempotency-Key to make retries safe."""
+    data, status = charge_wallet(get_db(), ticket_code, get_idempotency_key())
+    return jsonify(data), status
 
 @app.route("/book/<int:bus_id>", methods=["GET", "POST"])
 def book(bus_id):
@@ -547,34 +1795,28 @@ def book(bus_id):
         flash("Please log in before booking a ticket.", "warning")
         return redirect(url_for("login"))
 
-    conn = get_db_connection()
+    conn = get_db()
 
     # Get bus
     bus = conn.execute("SELECT * FROM buses WHERE id = ?", (bus_id,)).fetchone()
     if not bus:
-        conn.close()
         flash("Bus not found.", "danger")
         return redirect(url_for("home"))
 
     # Get logged-in user (for auto-filling name + email + wallet)
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    user = get_current_user()
 
     total_seats = bus["total_seats"]
-    booked_seats = get_booked_seats(bus_id)
+    booked_seats = get_booked_seats(bus_id, user_id)
 
     if request.method == "POST":
-        # Auto-take these from the logged-in account
-        name = user["name"]
-        email = user["email"]
-
-        # Only phone comes from the form
+        # Name + email come from the logged-in account, only phone from the form
         phone = request.form.get("phone", "").strip()
         selected_seats = request.form.get("selected_seats", "").strip()  # e.g. "1,2,3"
 
         # Basic validation
         if not phone or not selected_seats:
             flash("Please enter phone number and select at least one seat.", "danger")
-            conn.close()
             return render_template(
                 "book.html",
                 bus=bus,
@@ -584,15 +1826,10 @@ def book(bus_id):
             )
 
         # Parse seats
-        seats_list = []
-        for s in selected_seats.split(","):
-            s = s.strip()
-            if s.isdigit():
-                seats_list.append(int(s))
+        seats_list = parse_seat_numbers(selected_seats)
 
         if not seats_list:
             flash("Invalid seat selection.", "danger")
-            conn.close()
             return render_template(
                 "book.html",
                 bus=bus,
@@ -601,19 +1838,6 @@ def book(bus_id):
                 total_seats=total_seats,
             )
 
-        # Check that none of the selected seats are already booked
-        for s in seats_list:
-            if s in booked_seats:
-                flash(f"Seat {s} has already been booked. Please refresh and try again.", "danger")
-                conn.close()
-                return render_template(
-                    "book.html",
-                    bus=bus,
-                    user=user,
-                    booked_seats=booked_seats,
-                    total_seats=total_seats,
-                )
-
         quantity = len(seats_list)
         total_amount = quantity * bus["price"]
 
@@ -629,7 +1853,6 @@ def book(bus_id):
         wallet_balance = float(user["wallet_balance"])
 
         if wallet_balance < deposit_amount:
-            conn.close()
             flash(
                 f"You need at least ₹{deposit_amount:.2f} in your wallet for the booking deposit.",
                 "danger"
@@ -642,67 +1865,56 @@ def book(bus_id):
                 total_seats=total_seats,
             )
 
-        # Deduct deposit from wallet now
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE users SET wallet_balance = wallet_balance - ? WHERE id = ?",
-            (deposit_amount, user_id),
-        )
-
-        ticket_code = generate_ticket_code()
-        booked_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        seats_str = ",".join(str(s) for s in sorted(seats_list))
-
-        # Create ticket with deposit + remaining
-        cur.execute(
-            """
-            INSERT INTO tickets (
-                ticket_code,
-                bus_id,
-                user_id,
-                passenger_name,
-                passenger_email,
-                passenger_phone,
-                seat_numbers,
-                quantity,
-                total_amount,
-                deposit_amount,
-                remaining_amount,
-                payment_status,
-                booked_at
+        try:
+            ticket_id, ticket_code = create_booking(
+                conn, bus, user, phone, seats_list,
+                total_amount, deposit_amount, remaining_amount,
+            )
+        except InvalidSeatsError as e:
+            if wants_json():
+                return jsonify({"success": False, "reason": "invalid_seat", "seats": e.seats}), 400
+            flash("Invalid seat selection.", "danger")
+            return render_template(
+                "book.html",
+                bus=bus,
+                user=user,
+                booked_seats=booked_seats,
+                total_seats=total_seats,
+            )
+        except SeatConflictError as e:
+            if wants_json():
+                return jsonify({"success": False, "reason": "seat_conflict", "seats": e.seats}), 409
+            seats_txt = ", ".join(str(x) for x in e.seats)
+            flash(f"Seat {seats_txt} has already been booked. Please pick again.", "danger")
+            return render_template(
+                "book.html",
+                bus=bus,
+                user=user,
+                booked_seats=get_booked_seats(bus_id, user_id),
+                total_seats=total_seats,
+            )
+        except InsufficientBalanceError:
+            if wants_json():
+                return jsonify({"success": False, "reason": "Insufficient Wallet Balance"}), 400
+            flash(
+                f"You need at least ₹{deposit_amount:.2f} in your wallet for the booking deposit.",
+                "danger"
+            )
+            return render_template(
+                "book.html",
+                bus=bus,
+                user=user,
+                booked_seats=booked_seats,
+                total_seats=total_seats,
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                ticket_code,
-                bus_id,
-                user_id,
-                name,
-                email,
-                phone,
-                seats_str,
-                quantity,
-                total_amount,
-                deposit_amount,
-                remaining_amount,
-                "PENDING",   # will be fully paid on scan / NFC
-                booked_at,
-            ),
-        )
-        ticket_id = cur.lastrowid
-        conn.commit()
-        conn.close()
 
-        # store ticket_code in session so "My Bookings" can show it
-        session.setdefault("ticket_codes", [])
-        if ticket_code not in session["ticket_codes"]:
-            session["ticket_codes"].append(ticket_code)
+        if wants_json():
+            return jsonify({"success": True, "ticket_id": ticket_id, "ticket_code": ticket_code}), 201
 
         flash(f"Booking deposit of ₹{deposit_amount:.2f} has been taken from your wallet.", "info")
         return redirect(url_for("checkout", ticket_id=ticket_id))
 
     # GET -> show seat selection page (with user data prefilled)
-    conn.close()
     return render_template(
         "book.html",
         bus=bus,
@@ -711,39 +1923,78 @@ def book(bus_id):
         total_seats=total_seats,
     )
 
+@app.route("/api/hold/<int:bus_id>", methods=["POST"])
+def hold_seats(bus_id):
+    """Reserve the seats a user has picked on /book for SEAT_HOLD_TTL seconds."""
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({"success": False, "reason": "login_required"}), 401
+
+    data = request.get_json(silent=True) or request.form
+    seats = parse_seat_numbers(data.get("seats", ""))
+
+    conn = get_db()
+    bus = conn.execute("SELECT total_seats FROM buses WHERE id = ?", (bus_id,)).fetchone()
+    if not bus:
+        return jsonify({"success": False, "reason": "Bus not found"}), 404
+    if any(s < 1 or s > bus["total_seats"] for s in seats):
+        return jsonify({"success": False, "reason": "invalid_seat"}), 400
+
+    taken = get_booked_seats(bus_id, user_id) & set(seats)
+    if not taken:
+        taken = seat_holds.hold(bus_id, user_id, seats)
+    if taken:
+        return jsonify({"success": False, "reason": "seat_conflict", "seats": sorted(taken)}), 409
+
+    return jsonify({"success": True, "held": seats, "expires_in": seat_holds.ttl})
+
 @app.route("/bookings")
 def bookings():
-    """Show bookings associated with this browser (using session ticket_codes)."""
-    codes = session.get("ticket_codes", [])
-    if not codes:
-        return render_template("bookings.html", tickets=[])
+    """Show the logged-in user's bookings, newest first, a page at a time."""
+    user_id = session.get("user_id")
+    if not user_id:
+        flash("Please log in to see your bookings.", "warning")
+        return redirect(url_for("login"))
+    session.pop("ticket_codes", None)   # left over from before bookings were per user
 
-    placeholders = ",".join(["?"] * len(codes))
-    query = f"""
+    before_at = request.args.get("before_at", "").strip()
+    before_id = request.args.get("before_id", type=int)
+
+    query = """
         SELECT t.*, b.operator, b.from_city, b.to_city, b.departure, b.arrival
         FROM tickets t
         JOIN buses b ON t.bus_id = b.id
-        WHERE t.ticket_code IN ({placeholders})
-        ORDER BY t.booked_at DESC
+        WHERE t.user_id = ?
     """
+    params = [user_id]
+    if before_at and before_id:
+        query += " AND (t.booked_at, t.id) < (?, ?)"
+        params.extend([before_at, before_id])
+    query += " ORDER BY t.booked_at DESC, t.id DESC LIMIT ?"
+    params.append(BOOKINGS_PAGE + 1)
+
+    conn = get_db()
+    tickets_rows = conn.execute(query, params).fetchall()
+    has_more = len(tickets_rows) > BOOKINGS_PAGE
+    tickets_rows = tickets_rows[:BOOKINGS_PAGE]
 
-    conn = get_db_connection()
-    tickets_rows = conn.execute(query, codes).fetchall()
-    conn.close()
-
-    return render_template("bookings.html", tickets=tickets_rows)
+    return render_template(
+        "bookings.html",
+        tickets=tickets_rows,
+        has_more=has_more,
+        is_first_page=not (before_at and before_id),
+    )
 
 @app.route("/checkout/<int:ticket_id>", methods=["GET", "POST"])
 def checkout(ticket_id):
     """Payment simulation page – ticket stays PENDING, wallet is charged on scan."""
-    conn = get_db_connection()
+    conn = get_db()
     ticket = conn.execute("""
         SELECT t.*, b.operator, b.from_city, b.to_city, b.departure, b.arrival, b.bus_type
         FROM tickets t
         JOIN buses b ON t.bus_id = b.id
         WHERE t.id = ?
     """, (ticket_id,)).fetchone()
-    conn.close()
 
     if not ticket:
         flash("Ticket not found.", "danger")
@@ -759,7 +2010,7 @@ def checkout(ticket_id):
 
 @app.route("/ticket/<ticket_code>")
 def ticket(ticket_code):
-    conn = get_db_connection()
+    conn = get_db()
     ticket = conn.execute("""
         SELECT t.*, b.operator, b.from_city, b.to_city, b.departure, b.arrival,
                b.bus_type, b.total_seats, b.price
@@ -767,7 +2018,6 @@ def ticket(ticket_code):
         JOIN buses b ON t.bus_id = b.id
         WHERE t.ticket_code = ?
     """, (ticket_code,)).fetchone()
-    conn.close()
 
     if not ticket:
         flash("Ticket not found.", "danger")
@@ -775,25 +2025,12 @@ def ticket(ticket_code):
 
     seats_list = [s.strip() for s in ticket["seat_numbers"].split(",") if s.strip()]
 
-    # --- QR code generation ---
-    if not os.path.exists(QR_FOLDER):
-        os.makedirs(QR_FOLDER, exist_ok=True)
-
-    # filename relative to static/ (for url_for)
-    qr_filename = f"qr/{ticket['ticket_code']}.png"
-    qr_file_path = os.path.join("static", "qr", f"{ticket['ticket_code']}.png")
-
-    if not os.path.exists(qr_file_path):
-        # QR content: full ticket URL so scanning with phone opens the ticket page
-        qr_content = request.url  # e.g. http://127.0.0.1:5000/ticket/SPG-XXXXYYYY
-        img = qrcode.make(qr_content)
-        img.save(qr_file_path)
-
     return render_template(
         "ticket.html",
         ticket=ticket,
         seats_list=seats_list,
-        qr_filename=qr_filename,  # pass QR path to template
+        # QR content: full ticket URL so scanning with phone opens the ticket page
+        qr_url=url_for("ticket_qr", ticket_code=ticket["ticket_code"], fmt="png"),
     )
 
 @app.route("/admin")
@@ -803,13 +2040,13 @@ def admin():
         flash("Please log in as admin.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = get_db_connection()
+    conn = get_db()
     buses_rows = conn.execute("SELECT * FROM buses ORDER BY departure").fetchall()
-    conn.close()
+    occupancy = calculate_occupancy_batch(conn, buses_rows)
 
     buses_list = []
     for b in buses_rows:
-        occ = calculate_bus_occupancy(b)
+        occ = occupancy[b["id"]]
         buses_list.append({
             "id": b["id"],
             "operator": b["operator"],
@@ -845,15 +2082,20 @@ def admin_bus_new():
             flash("Please fill all fields.", "danger")
             return render_template("admin_bus_form.html", bus=None, mode="new")
 
-        conn = get_db_connection()
-        conn.execute("""
-            INSERT INTO buses (operator, from_city, to_city, departure, arrival,
-                               price, total_seats, bus_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (operator, from_city, to_city, departure, arrival,
-              float(price), int(total_seats), bus_type))
-        conn.commit()
-        conn.close()
+        conn = get_db()
+        try:
+            conn.execute("""
+                INSERT INTO buses (operator, from_city, to_city, departure, arrival,
+                                   price, total_seats, bus_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (operator, from_city, to_city, departure, arrival,
+                  float(price), int(total_seats), bus_type))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            flash("This operator already has a bus on that route at that departure time.", "danger")
+            return render_template("admin_bus_form.html", bus=None, mode="new")
+        bus_facets.invalidate()
 
         flash("Bus created successfully.", "success")
         return redirect(url_for("admin"))
@@ -867,11 +2109,10 @@ def admin_bus_edit(bus_id):
         flash("Please log in as admin.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = get_db_connection()
+    conn = get_db()
     bus = conn.execute("SELECT * FROM buses WHERE id = ?", (bus_id,)).fetchone()
 
     if not bus:
-        conn.close()
         flash("Bus not found.", "danger")
         return redirect(url_for("admin"))
 
@@ -887,36 +2128,87 @@ def admin_bus_edit(bus_id):
 
         if not all([operator, from_city, to_city, departure, arrival, price, total_seats, bus_type]):
             flash("Please fill all fields.", "danger")
-            conn.close()
             return render_template("admin_bus_form.html", bus=bus, mode="edit")
 
-        conn.execute("""
-            UPDATE buses
-            SET operator = ?, from_city = ?, to_city = ?, departure = ?, arrival = ?,
-                price = ?, total_seats = ?, bus_type = ?
-            WHERE id = ?
-        """, (operator, from_city, to_city, departure, arrival,
-              float(price), int(total_seats), bus_type, bus_id))
-        conn.commit()
-        conn.close()
+        try:
+            conn.execute("""
+                UPDATE buses
+                SET operator = ?, from_city = ?, to_city = ?, departure = ?, arrival = ?,
+                    price = ?, total_seats = ?, bus_type = ?
+                WHERE id = ?
+            """, (operator, from_city, to_city, departure, arrival,
+                  float(price), int(total_seats), bus_type, bus_id))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            flash("This operator already has a bus on that route at that departure time.", "danger")
+            return render_template("admin_bus_form.html", bus=bus, mode="edit")
+        bus_facets.invalidate()
 
         flash("Bus updated successfully.", "success")
         return redirect(url_for("admin"))
 
-    conn.close()
     return render_template("admin_bus_form.html", bus=bus, mode="edit")
 
 
+@app.route("/admin/bus/import", methods=["POST"])
+def admin_bus_import():
+    """Upload a timetable CSV (form field "file", or a raw text/csv body)."""
+    if not session.get("is_admin"):
+        flash("Please log in as admin.", "warning")
+        return redirect(url_for("admin_login"))
+
+    upload = request.files.get("file")
+    if upload:
+        stream = upload.stream
+    elif request.mimetype == "text/csv":
+        stream = request.stream
+    else:
+        if wants_json():
+            return jsonify({"success": False, "reason": "no CSV file"}), 400
+        flash("Please choose a CSV file to import.", "danger")
+        return redirect(url_for("admin"))
+
+    # parse straight off the upload instead of reading it into one string
+    lines = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        result = import_timetable(get_db(), lines)
+    except DuplicateTripsError as e:
+        if wants_json():
+            return jsonify({"success": False, "reason": "duplicate_trips", "bus_ids": e.groups}), 409
+        groups = ", ".join("/".join(str(i) for i in g) for g in e.groups)
+        flash(f"Some buses share operator, route and departure (bus ids {groups}). "
+              "Merge or delete them before importing.", "danger")
+        return redirect(url_for("admin"))
+
+    if wants_json():
+        return jsonify({"success": True, **result})
+
+    flash(
+        f"Imported {result['rows']} trips ({result['inserted']} new, {result['updated']} updated).",
+        "success" if result["rows"] else "warning",
+    )
+    if result["error_count"]:
+        shown = "; ".join(f"line {e['line']}: {e['error']}" for e in result["errors"][:10])
+        flash(f"{result['error_count']} rows rejected - {shown}", "danger")
+    return redirect(url_for("admin"))
+
+
 @app.route("/admin/bus/<int:bus_id>/delete", methods=["POST"])
 def admin_bus_delete(bus_id):
     if not session.get("is_admin"):
         flash("Please log in as admin.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = get_db_connection()
-    conn.execute("DELETE FROM buses WHERE id = ?", (bus_id,))
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    try:
+        conn.execute("DELETE FROM buses WHERE id = ?", (bus_id,))
+        conn.commit()
+        bus_facets.invalidate()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        flash("This bus still has tickets and cannot be deleted.", "danger")
+        return redirect(url_for("admin"))
 
     flash("Bus deleted.", "info")
     return redirect(url_for("admin"))
@@ -928,16 +2220,126 @@ def admin_tickets():
         flash("Please log in as admin.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = get_db_connection()
-    rows = conn.execute("""
+    # Filters (all optional) are kept on every page link
+    filters = get_ticket_filters()
+    before_at = request.args.get("before_at", "").strip()
+    before_id = request.args.get("before_id", type=int)
+
+    where, params = ticket_filter_sql(filters)
+    query = """
         SELECT t.*, b.operator, b.from_city, b.to_city, b.departure, b.arrival, b.bus_type
         FROM tickets t
         JOIN buses b ON t.bus_id = b.id
-        ORDER BY t.booked_at DESC
-    """).fetchall()
-    conn.close()
+        WHERE 1=1
+    """ + where
+
+    if before_at and before_id:
+        # keyset: continue strictly after the last row of the previous page
+        query += " AND (t.booked_at, t.id) < (?, ?)"
+        params.extend([before_at, before_id])
+
+    query += " ORDER BY t.booked_at DESC, t.id DESC LIMIT ?"
+    params.append(ADMIN_TICKETS_PAGE + 1)
+
+    # rows go from the cursor into the streamed HTML, never into a list.
+    # The stream outlives the request's get_db() connection, so it gets its own.
+    conn = get_db_connection()
+    tickets = KeysetPage(conn.execute(query, params), ADMIN_TICKETS_PAGE, conn)
+    return stream_template(
+        "admin_tickets.html",
+        tickets=tickets,
+        filters=filters,
+        is_first_page=not (before_at and before_id),
+    )
+
+
+EXPORT_COLUMNS = [
+    "id", "ticket_code", "booked_at", "payment_status", "payment_id",
+    "passenger_name", "passenger_email", "passenger_phone", "seat_numbers", "quantity",
+    "total_amount", "deposit_amount", "remaining_amount",
+    "bus_id", "operator", "from_city", "to_city", "departure", "bus_type", "price",
+]
+
+
+def iter_ticket_export(query, params, fmt):
+    """
+    Yield the export as encoded chunks of EXPORT_BATCH rows.
+    Runs in its own read transaction: WAL gives it one consistent snapshot
+    for the whole export while bookings and payments keep committing.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN")
+        cur = conn.execute(query, params)
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(EXPORT_COLUMNS)
+        while True:
+            rows = cur.fetchmany(EXPORT_BATCH)
+            if not rows:
+                break
+            if fmt == "csv":
+                writer.writerows(rows)
+                chunk = buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            else:
+                chunk = "".join(json.dumps(dict(zip(EXPORT_COLUMNS, r))) + "\n" for r in rows)
+            yield chunk.encode()
+        if fmt == "csv" and buf.tell():
+            yield buf.getvalue().encode()
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def gzip_chunks(chunks):
+    """Compress a chunk stream on the fly (gzip container, one compressor)."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route("/admin/export/tickets.<any(csv, ndjson):fmt>")
+def admin_export_tickets(fmt):
+    """
+    Stream tickets joined with their bus (same filters as /admin/tickets),
+    oldest first. Gzipped when the client accepts it, unless ?gzip=0.
+    """
+    if not session.get("is_admin"):
+        flash("Please log in as admin.", "warning")
+        return redirect(url_for("admin_login"))
+
+    where, params = ticket_filter_sql(get_ticket_filters())
+    columns = ", ".join(
+        f"b.{c}" if c in ("operator", "from_city", "to_city", "departure", "bus_type", "price")
+        else f"t.{c}"
+        for c in EXPORT_COLUMNS
+    )
+    query = f"""
+        SELECT {columns}
+        FROM tickets t
+        JOIN buses b ON t.bus_id = b.id
+        WHERE 1=1 {where}
+        ORDER BY t.booked_at, t.id
+    """
+
+    body = iter_ticket_export(query, params, fmt)
+    headers = {
+        "Content-Disposition": f"attachment; filename=tickets.{fmt}",
+        "Cache-Control": "no-store",
+        "Vary": "Accept-Encoding",
+    }
+    if request.args.get("gzip") != "0" and "gzip" in request.accept_encodings:
+        body = gzip_chunks(body)
+        headers["Content-Encoding"] = "gzip"
 
-    return render_template("admin_tickets.html", tickets=rows)
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(body, mimetype=mimetype, headers=headers)
 
 
 @app.route("/admin/ticket/<int:ticket_id>/delete", methods=["POST"])
@@ -946,14 +2348,40 @@ def admin_ticket_delete(ticket_id):
         flash("Please log in as admin.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = get_db_connection()
+    conn = get_db()
+    release_seats(conn, ticket_id)
     conn.execute("DELETE FROM tickets WHERE id = ?", (ticket_id,))
     conn.commit()
-    conn.close()
 
     flash("Ticket deleted.", "info")
     return redirect(url_for("admin_tickets"))
 
+@app.route("/admin/qr/pregen", methods=["POST"])
+def admin_qr_pregen():
+    """Kick off QR pre-generation for upcoming departures in the background."""
+    if not session.get("is_admin"):
+        flash("Please log in as admin.", "warning")
+        return redirect(url_for("admin_login"))
+
+    if not qr_pregen_lock.acquire(blocking=False):
+        flash("QR pre-generation is already running.", "warning")
+        return redirect(url_for("admin"))
+
+    base_url = request.host_url
+
+    def job():
+        try:
+            stats = pregenerate_qrs(base_url=base_url)
+            app.logger.info("QR pre-generation done: %s", stats)
+        except Exception:
+            app.logger.exception("QR pre-generation failed")
+        finally:
+            qr_pregen_lock.release()
+
+    threading.Thread(target=job, daemon=True).start()
+    flash(f"Generating QRs for departures in the next {QR_PREGEN_HOURS} hours.", "info")
+    return redirect(url_for("admin"))
+
 @app.route("/api/tap_pay/<ticket_code>", methods=["GET", "POST"])
 def tap_pay(ticket_code):
     """JSON API for real NFC / mobile app."""
@@ -963,13 +2391,12 @@ def tap_pay(ticket_code):
 @app.route("/simulate_nfc/<int:ticket_id>")
 def simulate_nfc(ticket_id):
     """Simulated NFC payment — no ticket code required."""
-    conn = get_db_connection()
+    conn = get_db()
     ticket = conn.execute("""
         SELECT * FROM tickets WHERE id = ?
     """, (ticket_id,)).fetchone()
 
     if not ticket:
-        conn.close()
         flash("Ticket not found.", "danger")
         return redirect(url_for("home"))
 
@@ -980,8 +2407,9 @@ def simulate_nfc(ticket_id):
         SET payment_status = 'PAID', payment_id = ?
         WHERE id = ?
     """, (payment_id, ticket_id))
+    set_seats_status(conn, ticket_id, "PAID")
     conn.commit()
-    conn.close()
+    publish_paid(ticket_id, ticket["ticket_code"])
 
     flash("NFC payment successful!", "success")
 
@@ -1012,10 +2440,9 @@ def simulate_nfc_process(ticket_id):
     This is the same logic as scanning with the hardware scanner,
     but triggered from the fancy NFC animation page.
     """
-    import time
-    time.sleep(2)  # simulate NFC scan delay
-
-    conn = get_db_connection()
+    # The "scan delay" is only the animation in simulate_nfc.html;
+    # sleeping here would hold a worker thread for nothing.
+    conn = get_db()
 
     # Load ticket + its owner + wallet balance
     ticket = conn.execute("""
@@ -1026,14 +2453,12 @@ def simulate_nfc_process(ticket_id):
     """, (ticket_id,)).fetchone()
 
     if not ticket:
-        conn.close()
         flash("Ticket not found.", "danger")
         return redirect(url_for("home"))
 
     # If already paid, just go to ticket page
     if ticket["payment_status"] == "PAID":
         code = ticket["ticket_code"]
-        conn.close()
         flash("This ticket has already been paid.", "info")
         return redirect(url_for("ticket", ticket_code=code))
 
@@ -1042,7 +2467,6 @@ def simulate_nfc_process(ticket_id):
 
     # Not enough money in wallet
     if balance < fare:
-        conn.close()
         flash("Insufficient wallet balance for NFC payment.", "danger")
         return redirect(url_for("checkout", ticket_id=ticket_id))
 
@@ -1059,10 +2483,12 @@ def simulate_nfc_process(ticket_id):
             payment_id = ?
         WHERE id = ?
     """, (generate_payment_id(), ticket_id))
+    set_seats_status(conn, ticket_id, "PAID")
 
     conn.commit()
+    forget_current_user()
     code = ticket["ticket_code"]
-    conn.close()
+    publish_paid(ticket_id, code)
 
     flash(f"NFC Payment Successful! ₹{fare:.2f} deducted from wallet.", "success")
     return redirect(url_for("ticket", ticket_code=code))
@@ -1070,34 +2496,218 @@ def simulate_nfc_process(ticket_id):
 @app.route("/api/validate/<ticket_code>")
 def api_validate(ticket_code):
     """API for hardware/scanner to validate a ticket by its code."""
-    conn = get_db_connection()
+    # forged / mistyped codes are rejected without touching SQLite
+    if not verify_ticket_code(ticket_code):
+        return jsonify({"valid": False, "reason": "Ticket Not Found"}), 404
+
+    conn = get_db()
     ticket = conn.execute("""
         SELECT t.*, b.operator, b.from_city, b.to_city, b.departure, b.arrival
         FROM tickets t
         JOIN buses b ON t.bus_id = b.id
         WHERE t.ticket_code = ?
     """, (ticket_code,)).fetchone()
-    conn.close()
 
+    data, status = validation_verdict(ticket)
+    return jsonify(data), status
+
+
+def validation_verdict(ticket):
+    """(data, status) a scanner gets for a looked-up ticket row (None = not found -> 404)."""
     if not ticket:
-        return jsonify({"valid": False, "reason": "Ticket Not Found"}), 404
+        return {"valid": False, "reason": "Ticket Not Found"}, 404
 
     if ticket["payment_status"] != "PAID":
-        return jsonify({"valid": False, "reason": "unpaid"}), 400
+        return {"valid": False, "reason": "unpaid"}, 400
 
     # if later you add a 'boarded' column, you can handle it here
-    return jsonify({
+    return ticket_summary(ticket), 200
+
+
+@app.route("/api/validate_batch", methods=["POST"])
+def api_validate_batch():
+    """
+    Validate many codes in one round trip (depot gates, multi-door buses).
+    Body: {"codes": [...]}. Each result is what /api/validate would answer
+    for that code, plus its "http_status"; results keep the request order.
+    """
+    payload = request.get_json(silent=True)
+    codes = payload.get("codes") if isinstance(payload, dict) else None
+    if not isinstance(codes, list) or not all(isinstance(c, str) for c in codes):
+        return jsonify({"success": False, "reason": "codes must be a list of strings"}), 400
+    if len(codes) > VALIDATE_BATCH_MAX:
+        return jsonify({"success": False, "reason": f"max {VALIDATE_BATCH_MAX} codes per batch"}), 400
+
+    # forged codes never reach SQLite; duplicates are looked up once
+    lookup = list({c for c in codes if verify_ticket_code(c)})
+    tickets = {}
+    conn = get_db()
+    for i in range(0, len(lookup), SQL_PARAM_CHUNK):
+        chunk = lookup[i:i + SQL_PARAM_CHUNK]
+        placeholders = ",".join(["?"] * len(chunk))
+        rows = conn.execute(f"""
+            SELECT t.ticket_code, t.bus_id, t.passenger_name, t.seat_numbers, t.payment_status
+            FROM tickets t
+            JOIN buses b ON t.bus_id = b.id
+            WHERE t.ticket_code IN ({placeholders})
+        """, chunk).fetchall()
+        for r in rows:
+            tickets[r["ticket_code"]] = r
+
+    results = []
+    for code in codes:
+        data, status = validation_verdict(tickets.get(code))
+        results.append({"ticket_code": code, "http_status": status, **data})
+    return jsonify({"success": True, "results": results})
+
+
+def ticket_summary(ticket, status=None):
+    """Fields a scanner shows for a valid ticket."""
+    return {
         "valid": True,
         "ticket_code": ticket["ticket_code"],
         "bus_id": ticket["bus_id"],
         "passenger": ticket["passenger_name"],
         "seat_numbers": ticket["seat_numbers"],
-        "status": ticket["payment_status"],
+        "status": status or ticket["payment_status"],
+    }
+
+
+def scanner_auth_error():
+    """None if the request carries the scanners' X-Scanner-Token, else an error response."""
+    if not SCANNER_TOKEN:
+        return jsonify({"success": False, "reason": "scanner token not configured"}), 503
+    token = request.headers.get("X-Scanner-Token", "")
+    if not hmac.compare_digest(token.encode(), SCANNER_TOKEN.encode()):
+        return jsonify({"success": False, "reason": "invalid scanner token"}), 403
+    return None
+
+
+@app.route("/api/manifest/<int:bus_id>")
+def api_manifest(bus_id):
+    """
+    Compact trip manifest a scanner downloads before departure, so it can keep
+    validating offline: ticket_code -> [payment_status, remaining_amount].
+    Scanners only: it lists every code on the bus.
+    """
+    denied = scanner_auth_error()
+    if denied:
+        return denied
+
+    conn = get_db()
+    bus = conn.execute("SELECT id, departure FROM buses WHERE id = ?", (bus_id,)).fetchone()
+    if not bus:
+        return jsonify({"success": False, "reason": "Bus not found"}), 404
+
+    rows = conn.execute("""
+        SELECT ticket_code, payment_status, remaining_amount FROM tickets
+        WHERE bus_id = ? AND payment_status IN ('PENDING', 'PAID')
+    """, (bus_id,)).fetchall()
+
+    return jsonify({
+        "bus_id": bus_id,
+        "departure": bus["departure"],
+        "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "tickets": {
+            r["ticket_code"]: [r["payment_status"], float(r["remaining_amount"] or 0.0)]
+            for r in rows
+        },
+    })
+
+
+@app.route("/api/sync_payments", methods=["POST"])
+def api_sync_payments():
+    """
+    Replay payments an offline scanner accepted while it had no link.
+    Body: {"payments": [{"ticket_code", "idempotency_key", "amount"}, ...]}
+    Each item is charged through charge_wallet() with its idempotency key, so
+    re-sending a batch is safe. Items that can't be charged come back as conflicts.
+    """
+    denied = scanner_auth_error()
+    if denied:
+        return denied
+
+    payload = request.get_json(silent=True)
+    payments = payload.get("payments") if isinstance(payload, dict) else None
+    if not isinstance(payments, list) or not all(
+        isinstance(p, dict)
+        and isinstance(p.get("ticket_code"), str)
+        and isinstance(p.get("idempotency_key"), str)
+        for p in payments
+    ):
+        return jsonify({
+            "success": False,
+            "reason": "payments must be a list of objects with string ticket_code and idempotency_key",
+        }), 400
+    if len(payments) > SYNC_BATCH_MAX:
+        return jsonify({"success": False, "reason": f"max {SYNC_BATCH_MAX} payments per batch"}), 400
+
+    conn = get_db()
+    results = []
+    for p in payments:
+        code = p["ticket_code"]
+        data, status = charge_wallet(conn, code, p["idempotency_key"])
+        if not data["success"]:
+            result = "conflict"
+        elif "deducted_amount" in data:
+            result = "charged"
+        else:
+            result = "already_paid"
+        results.append({
+            "ticket_code": code,
+            "idempotency_key": p["idempotency_key"],
+            "result": result,
+            "reason": data.get("reason"),
+            "deducted_amount": data.get("deducted_amount"),
+        })
+
+    return jsonify({"success": True, "results": results})
+
+
+@app.route("/api/scan/<ticket_code>", methods=["POST"])
+def api_scan(ticket_code):
+    """
+    One round trip for the door scanner: validate the ticket and, if it is
+    unpaid, charge the remaining fare from the wallet. Answers with the final
+    boarding verdict (reason = already_paid / wallet_paid / failure reason).
+    """
+    if not verify_ticket_code(ticket_code):
+        return jsonify({"valid": False, "reason": "Ticket Not Found"}), 404
+
+    conn = get_db()
+    ticket = conn.execute("""
+        SELECT ticket_code, bus_id, passenger_name, seat_numbers, payment_status
+        FROM tickets
+        WHERE ticket_code = ?
+    """, (ticket_code,)).fetchone()
+
+    if not ticket:
+        return jsonify({"valid": False, "reason": "Ticket Not Found"}), 404
+
+    # a retried scan whose first attempt paid gets the original wallet_paid answer
+    # (a key recorded for another ticket falls through to charge_wallet's 409)
+    key = get_idempotency_key()
+    if ticket["payment_status"] == "PAID" and not (key and get_payment_request(conn, key, ticket_code)):
+        return jsonify({**ticket_summary(ticket), "reason": "already_paid"})
+
+    data, status = charge_wallet(conn, ticket_code, key)
+    if not data["success"]:
+        return jsonify({"valid": False, "reason": data.get("reason", "wallet_error")}), status
+
+    if "deducted_amount" not in data:
+        # paid by someone else in the meantime (or nothing left to pay)
+        return jsonify({**ticket_summary(ticket, "PAID"), "reason": "already_paid"})
+
+    return jsonify({
+        **ticket_summary(ticket, "PAID"),
+        "reason": "wallet_paid",
+        "deducted_amount": data["deducted_amount"],
     })
 
+# Every entry point (python app.py, flask run, a WSGI server, the CLI commands)
+# imports this module, so the schema is brought up to date here: one SELECT when current
+with app.app_context():
+    init_db()
+
 if __name__ == "__main__":
-    if not os.path.exists(DB_NAME):
-        init_db()
-    else:
-        init_db()
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,62 @@
+"""
+Timetable import: a 50k-row CSV through import_timetable() (fresh, then
+re-imported as upserts) against the one INSERT + commit per row that the
+admin form does, timed on a sample and scaled up.
+
+    python benchmarks/bench_import.py [rows]
+"""
+import io
+import sys
+import time
+from datetime import datetime, timedelta
+
+from common import app
+
+CITIES = ["Chennai", "Madurai", "Coimbatore", "Bengaluru", "Trichy", "Salem"]
+PER_ROW_SAMPLE = 2000
+
+
+def timetable_csv(n):
+    out = io.StringIO()
+    out.write(",".join(app.TIMETABLE_COLUMNS) + "\n")
+    start = datetime(2030, 1, 1)
+    for i in range(n):
+        dep = start + timedelta(minutes=i)
+        arr = dep + timedelta(hours=6)
+        src = CITIES[i % len(CITIES)]
+        dst = CITIES[(i + 1) % len(CITIES)]
+        out.write(f"Bench Travels,{src},{dst},{dep:%Y-%m-%d %H:%M},{arr:%Y-%m-%d %H:%M},"
+                  f"{400 + i % 300},40,AC Sleeper\n")
+    return out.getvalue().splitlines()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    lines = timetable_csv(n)
+    conn = app.get_db_connection()
+
+    for label in ("fresh", "re-import"):
+        started = time.perf_counter()
+        result = app.import_timetable(conn, lines)
+        elapsed = time.perf_counter() - started
+        print(f"import_timetable {label:<9} {n} rows: {elapsed:6.2f}s "
+              f"({result['inserted']} inserted, {result['updated']} updated)")
+
+    # the admin form's shape, on operators that don't collide with the import
+    rows = [app.parse_timetable_row(r.split(",")) for r in lines[1:PER_ROW_SAMPLE + 1]]
+    started = time.perf_counter()
+    for row in rows:
+        conn.execute("""
+            INSERT INTO buses (operator, from_city, to_city, departure, arrival,
+                               price, total_seats, bus_type)
+            VALUES ('Per Row', ?, ?, ?, ?, ?, ?, ?)
+        """, row[1:])
+        conn.commit()
+    elapsed = time.perf_counter() - started
+    print(f"row-at-a-time commit {len(rows)} rows: {elapsed:6.2f}s "
+          f"(~{elapsed / len(rows) * n:.1f}s for {n})")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Occupancy for a list of buses: one connection + query per bus (what /buses
+and /admin did before) against calculate_occupancy_batch().
+
+    python benchmarks/bench_occupancy.py
+"""
+from common import app, best_ms
+
+BUS_COUNTS = (10, 100, 300, 1000)
+SEATS_BOOKED = 10   # per bus
+
+
+def add_buses(conn, n):
+    """Append buses (with one 10-seat booking each) until there are n."""
+    have = conn.execute("SELECT COUNT(*) FROM buses").fetchone()[0]
+    for i in range(have, n):
+        cur = conn.execute("""
+            INSERT INTO buses (operator, from_city, to_city, departure, arrival, price, total_seats, bus_type)
+            VALUES ('Bench', 'Chennai', 'Madurai', ?, ?, 500, 40, 'AC Seater')
+        """, (f"2030-01-01 {i // 60 % 24:02d}:{i % 60:02d}:{i // 1440:02d}", "2030-01-02 00:00"))
+        bus_id = cur.lastrowid
+        cur = conn.execute("""
+            INSERT INTO tickets (ticket_code, bus_id, user_id, passenger_name, passenger_email,
+                                 passenger_phone, seat_numbers, quantity, total_amount,
+                                 deposit_amount, remaining_amount, payment_status, booked_at)
+            VALUES (?, ?, 1, 'b', 'b@example.com', '0', '', ?, 0, 0, 0, 'PENDING', '2030-01-01 00:00:00')
+        """, (f"SPG-B{bus_id:07d}", bus_id, SEATS_BOOKED))
+        app.claim_seats(conn, bus_id, cur.lastrowid, range(1, SEATS_BOOKED + 1))
+    conn.commit()
+
+
+def per_bus(bus_rows):
+    """The old N+1 shape: a fresh connection and a query for every bus."""
+    result = {}
+    for b in bus_rows:
+        conn = app.get_db_connection()
+        booked = conn.execute(
+            "SELECT COUNT(*) FROM ticket_seats WHERE bus_id = ?", (b["id"],)
+        ).fetchone()[0]
+        conn.close()
+        result[b["id"]] = app.occupancy_dict(booked, b["total_seats"])
+    return result
+
+
+def main():
+    conn = app.get_db_connection()
+    conn.execute("INSERT OR IGNORE INTO users (id, name, email, password) VALUES (1, 'b', 'b@example.com', 'x')")
+    print(f"{'buses':>6} {'per bus (ms)':>13} {'batched (ms)':>13}")
+    for n in BUS_COUNTS:
+        add_buses(conn, n)
+        bus_rows = conn.execute("SELECT id, total_seats FROM buses LIMIT ?", (n,)).fetchall()
+        assert per_bus(bus_rows) == app.calculate_occupancy_batch(conn, bus_rows)
+        print(f"{n:>6} {best_ms(lambda: per_bus(bus_rows)):>13.2f} "
+              f"{best_ms(lambda: app.calculate_occupancy_batch(conn, bus_rows)):>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
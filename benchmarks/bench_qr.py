@@ -0,0 +1,74 @@
+"""
+Ticket QR codes: the old render-to-disk-once scheme (cold render + save, then
+an exists() check per hit) against /qr served from the in-memory cache,
+cold, warm and revalidated with If-None-Match (304).
+
+    python benchmarks/bench_qr.py
+"""
+import os
+
+import qrcode
+
+from common import app, best_ms
+
+N = 50
+
+
+def make_tickets(client):
+    """Book one ticket through the app and clone it into N signed tickets."""
+    client.post("/register", data={"name": "Bench", "email": "bench@example.com", "password": "bench"})
+    client.post("/book/1", data={"phone": "1", "selected_seats": "1"},
+                headers={"Accept": "application/json"})
+    conn = app.get_db_connection()
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(tickets)") if r[1] not in ("id", "ticket_code")]
+    codes = []
+    for ticket_id in range(1000, 1000 + N):
+        code = app.sign_ticket_code(ticket_id, 1)
+        conn.execute(f"""
+            INSERT INTO tickets (id, ticket_code, {", ".join(cols)})
+            SELECT ?, ?, {", ".join(cols)} FROM tickets WHERE id = 1
+        """, (ticket_id, code))
+        codes.append(code)
+    conn.commit()
+    conn.close()
+    return codes
+
+
+def time_each(fn, items):
+    """One pass over items (a cold pass can only run once), in ms per item."""
+    return best_ms(lambda: [fn(x) for x in items], repeat=1) / len(items)
+
+
+def main():
+    client = app.app.test_client()
+    codes = make_tickets(client)
+    app.qr_cache = app.QRCache(app.QR_CACHE_MAX_BYTES)
+
+    os.makedirs("qr_bench", exist_ok=True)
+
+    def disk(code):
+        path = os.path.join("qr_bench", f"{code}.png")
+        if not os.path.exists(path):
+            qrcode.make(f"http://localhost/ticket/{code}").save(path)
+
+    etags = {}
+
+    def fetch(code):
+        r = client.get(f"/qr/{code}.png")
+        assert r.status_code == 200, r.status_code
+        etags[code] = r.headers["ETag"]
+
+    def revalidate(code):
+        r = client.get(f"/qr/{code}.png", headers={"If-None-Match": etags[code]})
+        assert r.status_code == 304, r.status_code
+
+    print(f"{N} tickets, ms per request")
+    print(f"  disk cold (render + save)  {time_each(disk, codes):7.3f}")
+    print(f"  disk warm (exists only)    {time_each(disk, codes):7.3f}")
+    print(f"  /qr cold                   {time_each(fetch, codes):7.3f}")
+    print(f"  /qr warm                   {time_each(fetch, codes):7.3f}")
+    print(f"  /qr 304                    {time_each(revalidate, codes):7.3f}")
+
+
+if __name__ == "__main__":
+    main()
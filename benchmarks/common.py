@@ -0,0 +1,25 @@
+"""Shared setup for the benchmark scripts: the app on a scratch database."""
+import os
+import sys
+import tempfile
+import time
+
+WORKDIR = tempfile.mkdtemp(prefix="scanpaygo-bench-")
+# app.py migrates its database and loads the signing key on import
+os.environ["SCANPAYGO_DB"] = os.path.join(WORKDIR, "tickets.db")
+os.environ.setdefault("SCANPAYGO_TICKET_KEY", "scanpaygo-bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(WORKDIR)   # qr_store/ and friends
+
+import app  # noqa: E402
+
+
+def best_ms(fn, repeat=5, number=1):
+    """Best of `repeat` runs of fn() called `number` times, in ms per call."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best * 1000
@@ -1,85 +1,96 @@
+import os
 import time
+import queue
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
 import cv2
+import numpy as np
 import requests
 import winsound
-import re
+import uuid
+
+from ticket_codes import find_ticket_code, load_signing_key
 
 API_BASE = "http://127.0.0.1:5000"  # Flask backend
 WINDOW_NAME = "ScanPayGo - Bus Ticket Scanner"
 
+# Frame pipeline tuning (adjust per device)
+DETECT_WIDTH = 480          # frames are downscaled to this width for the cheap detect pass
+ROI_MARGIN = 0.25           # extra border around a found QR, as a fraction of its size
+FRAME_BUDGET = 1 / 15       # seconds of decode work per processed frame before we skip frames
+MAX_FRAME_STRIDE = 4        # process at most every Nth frame when the box is struggling
+STATS_EVERY = 5.0           # seconds between timing printouts
+
+# Offline mode
+OFFLINE_DB = "scanner_offline.db"   # local manifest + payment queue (survives restarts)
+SYNC_INTERVAL = 10.0                # seconds between attempts to replay offline payments
+SYNC_BATCH = 100                    # payments sent per /api/sync_payments call
+CONNECT_TIMEOUT = 1.0               # seconds to reach the backend before a scan falls back to the manifest
+SCAN_TIMEOUT = 5.0                  # seconds the backend gets to answer a scan
+PROBE_INTERVAL = 2.0                # seconds between link checks while offline
+
+# One keep-alive HTTP session for every scan (no new TCP/TLS setup per passenger)
+SESSION = requests.Session()
+
 
 def extract_ticket_code(decoded_text: str) -> str | None:
     """
     Extract ticket code from the QR content.
     We expect either:
       - full URL: http://127.0.0.1:5000/ticket/SPG-XXXXXXXX
-      - or just the code: SPG-XXXXXXXX
+      - or just the code: SPG-XXXXXXXX (or signed SPG-<id>-<bus>-<nonce>-<tag>)
+    Signed codes with a bad HMAC tag are dropped here, before any API call.
     """
-    m = re.search(r"(SPG-[A-Z0-9]+)", decoded_text)
-    if m:
-        return m.group(1)
-    return None
+    return find_ticket_code(decoded_text)
 
 
-def validate_ticket(ticket_code: str) -> dict:
+def validate_ticket(ticket_code: str, offline: "OfflineStore | None" = None) -> dict:
     """
-    MAIN LOGIC:
+    MAIN LOGIC – one request: POST /api/scan/<ticket_code>
 
-    1) Ask backend: /api/validate/<ticket_code>
-       - if status=200 & valid -> already paid, just board.
-       - if status=400 & reason='unpaid' -> we try wallet payment.
+    The backend validates the ticket and, if it is still unpaid, deducts the
+    remaining fare from the user's wallet in the same call.
+      - 200 -> valid; reason is 'already_paid' or 'wallet_paid'
+      - 400 -> unpaid and the wallet could not cover it (reason says why)
+      - 404 -> ticket not found
 
-    2) Wallet payment: POST /api/wallet_pay/<ticket_code>
-       - if 200 -> fare deducted from user's wallet, mark PAID.
-       - if 400 -> insufficient wallet balance or error.
+    The Idempotency-Key makes a retried scan return the first answer
+    instead of charging the wallet twice.
+
+    If the backend can't be reached and an OfflineStore is given, the ticket
+    is checked against the prefetched manifest instead. After one failure the
+    store marks the link down and later scans go straight to the manifest
+    (no timeout per passenger) until SyncWorker sees the backend again.
     """
+    if offline is not None and not offline.link_up():
+        return offline.validate(ticket_code)
 
     try:
-        # STEP 1: Check current status
-        url = f"{API_BASE}/api/validate/{ticket_code}"
-        resp = requests.get(url, timeout=5)
-
-        # ---- CASE A: Ticket already PAID ----
+        url = f"{API_BASE}/api/scan/{ticket_code}"
+        resp = SESSION.post(
+            url,
+            headers={"Idempotency-Key": uuid.uuid4().hex},
+            # with a manifest to fall back on, don't wait long for a dead link
+            timeout=(CONNECT_TIMEOUT, SCAN_TIMEOUT) if offline is not None else SCAN_TIMEOUT,
+        )
+
+        # ---- CASE A: boarding allowed (already paid or just paid) ----
         if resp.status_code == 200:
             data = resp.json()
             if data.get("valid"):
                 return {
                     "status": "valid",
-                    "reason": "already_paid",
+                    "reason": data.get("reason", "already_paid"),
                     "data": data,
                 }
 
-        # ---- CASE B: Ticket exists but unpaid (400) ----
+        # ---- CASE B: unpaid and wallet payment failed (400) ----
         if resp.status_code == 400:
-            reason = resp.json().get("reason")
-
-            if reason == "unpaid":
-                # STEP 2: Try wallet deduction
-                pay_url = f"{API_BASE}/api/wallet_pay/{ticket_code}"
-                pay_resp = requests.post(pay_url, timeout=5)
-
-                # Wallet payment success
-                if pay_resp.status_code == 200:
-                    pay_data = pay_resp.json()
-                    return {
-                        "status": "valid",
-                        "reason": "wallet_paid",
-                        "data": pay_data,
-                    }
-
-                # Wallet payment failed (not enough balance, etc.)
-                else:
-                    failure_reason = pay_resp.json().get("reason", "wallet_error")
-                    return {
-                        "status": "invalid",
-                        "reason": failure_reason,
-                        "data": None,
-                    }
-
-            # Some other failure reason from backend
             return {
                 "status": "invalid",
-                "reason": reason,
+                "reason": resp.json().get("reason", "wallet_error"),
                 "data": None,
             }
 
@@ -98,6 +109,17 @@ def validate_ticket(ticket_code: str) -> dict:
             "data": None,
         }
 
+    except requests.RequestException as e:
+        print("API ERROR:", e)
+        if offline is not None:
+            offline.mark_offline()
+            return offline.validate(ticket_code)
+        return {
+            "status": "invalid",
+            "reason": "api_error",
+            "data": None,
+        }
+
     except Exception as e:
         print("API ERROR:", e)
         return {
@@ -116,7 +138,410 @@ def beep_invalid():
     winsound.Beep(400, 300)
 
 
+class OfflineStore:
+    """
+    Offline fallback for one bus, kept in a local SQLite file:
+
+      - manifest: ticket_code -> (payment_status, remaining_amount), downloaded
+        from /api/manifest/<bus_id> before departure and held in a dict for O(1) lookups
+      - pending_payments: fares accepted while offline, replayed later by SyncWorker
+
+    It also tracks whether the backend is reachable: validate_ticket() marks
+    the link down on a failed request, SyncWorker marks it up again.
+    """
+
+    def __init__(self, bus_id, path=OFFLINE_DB):
+        self.bus_id = bus_id
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS manifest (
+                bus_id INTEGER NOT NULL,
+                ticket_code TEXT NOT NULL,
+                payment_status TEXT NOT NULL,
+                remaining_amount REAL NOT NULL,
+                PRIMARY KEY (bus_id, ticket_code)
+            );
+            CREATE TABLE IF NOT EXISTS pending_payments (
+                idempotency_key TEXT PRIMARY KEY,
+                ticket_code TEXT NOT NULL,
+                amount REAL NOT NULL,
+                scanned_at TEXT NOT NULL,
+                synced INTEGER NOT NULL DEFAULT 0,
+                result TEXT,                 -- charged / already_paid / conflict
+                reason TEXT
+            );
+        """)
+        self.tickets = {}
+        self.online = threading.Event()
+        self.online.set()
+        self.load()
+
+    def link_up(self):
+        return self.online.is_set()
+
+    def mark_offline(self):
+        if self.online.is_set():
+            self.online.clear()
+            print("Backend unreachable – validating against the manifest.")
+
+    def mark_online(self):
+        if not self.online.is_set():
+            self.online.set()
+            print("Backend reachable again.")
+
+    def load(self):
+        """Load the saved manifest for this bus into memory."""
+        rows = self.db.execute(
+            "SELECT ticket_code, payment_status, remaining_amount FROM manifest WHERE bus_id = ?",
+            (self.bus_id,)
+        ).fetchall()
+        with self.lock:
+            self.tickets = {code: [status, remaining] for code, status, remaining in rows}
+        return len(self.tickets)
+
+    def refresh(self):
+        """Download a fresh manifest. Returns False (keeping the saved one) when offline."""
+        try:
+            resp = SESSION.get(f"{API_BASE}/api/manifest/{self.bus_id}", timeout=10)
+            resp.raise_for_status()
+            tickets = resp.json()["tickets"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print("Manifest download failed:", e)
+            return False
+
+        with self.lock:
+            # tickets we already charged offline stay PAID until the sync confirms it
+            unsynced = {
+                code for (code,) in self.db.execute(
+                    "SELECT ticket_code FROM pending_payments WHERE synced = 0"
+                )
+            }
+            for code in unsynced & tickets.keys():
+                tickets[code] = ["PAID", 0.0]
+
+            self.db.execute("DELETE FROM manifest WHERE bus_id = ?", (self.bus_id,))
+            self.db.executemany(
+                "INSERT INTO manifest VALUES (?, ?, ?, ?)",
+                [(self.bus_id, code, st, rem) for code, (st, rem) in tickets.items()]
+            )
+            self.db.commit()
+            self.tickets = tickets
+        return True
+
+    def validate(self, ticket_code):
+        """Validate against the manifest; unpaid fares are queued for later sync."""
+        with self.lock:
+            entry = self.tickets.get(ticket_code)
+            if entry is None:
+                return {"status": "invalid", "reason": "Ticket Not Found (offline)", "data": None}
+
+            status, remaining = entry
+            if status == "PAID" or remaining <= 0:
+                return {"status": "valid", "reason": "already_paid", "data": {"offline": True}}
+
+            # Accept now, charge the wallet when the link is back
+            key = uuid.uuid4().hex
+            self.db.execute(
+                "INSERT INTO pending_payments (idempotency_key, ticket_code, amount, scanned_at) VALUES (?, ?, ?, ?)",
+                (key, ticket_code, remaining, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            self.db.execute(
+                "UPDATE manifest SET payment_status = 'PAID', remaining_amount = 0 WHERE bus_id = ? AND ticket_code = ?",
+                (self.bus_id, ticket_code)
+            )
+            self.db.commit()
+            self.tickets[ticket_code] = ["PAID", 0.0]
+
+        return {
+            "status": "valid",
+            "reason": "wallet_paid",
+            "data": {"deducted_amount": remaining, "offline": True},
+        }
+
+    def unsynced(self, limit=SYNC_BATCH):
+        with self.lock:
+            rows = self.db.execute("""
+                SELECT idempotency_key, ticket_code, amount FROM pending_payments
+                WHERE synced = 0 ORDER BY scanned_at LIMIT ?
+            """, (limit,)).fetchall()
+        return [{"idempotency_key": k, "ticket_code": c, "amount": a} for k, c, a in rows]
+
+    def mark_synced(self, results):
+        with self.lock:
+            self.db.executemany(
+                "UPDATE pending_payments SET synced = 1, result = ?, reason = ? WHERE idempotency_key = ?",
+                [(r["result"], r.get("reason"), r["idempotency_key"]) for r in results]
+            )
+            self.db.commit()
+
+
+class SyncWorker(threading.Thread):
+    """
+    Replays offline payments to the backend in batches whenever the link is up.
+    While the store has the link marked down it probes the backend every
+    PROBE_INTERVAL, so scans go back online as soon as it answers.
+    """
+
+    def __init__(self, store):
+        super().__init__(daemon=True)
+        self.store = store
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    def sync_once(self):
+        """Send every queued payment. Returns the list of conflicts reported by the server."""
+        conflicts = []
+        while True:
+            batch = self.store.unsynced()
+            if not batch:
+                break
+            try:
+                resp = SESSION.post(f"{API_BASE}/api/sync_payments", json={"payments": batch}, timeout=10)
+                resp.raise_for_status()
+                results = resp.json()["results"]
+            except requests.RequestException:
+                self.store.mark_offline()
+                break   # still offline – try again next round
+            except (ValueError, KeyError):
+                break
+
+            self.store.mark_synced(results)
+            for r in results:
+                if r["result"] == "conflict":
+                    print(f"SYNC CONFLICT: {r['ticket_code']} – {r.get('reason')}")
+                    conflicts.append(r)
+            print(f"Synced {len(results)} offline payment(s).")
+        return conflicts
+
+    def probe(self):
+        """True if the backend answers at all (an empty sync batch is the cheapest call)."""
+        try:
+            SESSION.post(f"{API_BASE}/api/sync_payments", json={"payments": []},
+                         timeout=(CONNECT_TIMEOUT, SCAN_TIMEOUT))
+        except requests.RequestException:
+            return False
+        return True
+
+    def run(self):
+        last_sync = 0.0
+        while not self.stopping.is_set():
+            if not self.store.link_up():
+                if not self.probe():
+                    self.stopping.wait(PROBE_INTERVAL)
+                    continue
+                self.store.mark_online()
+                last_sync = 0.0   # replay the backlog right away
+            if time.monotonic() - last_sync >= SYNC_INTERVAL:
+                self.sync_once()
+                last_sync = time.monotonic()
+            self.stopping.wait(PROBE_INTERVAL)
+
+
+class ValidationWorker(threading.Thread):
+    """
+    Runs validate_ticket() (and the beeps) off the camera loop.
+    main() submits codes and polls results, so a slow API never freezes the preview.
+    """
+
+    def __init__(self, offline=None):
+        super().__init__(daemon=True)
+        self.offline = offline
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+
+    def submit(self, ticket_code):
+        self.jobs.put(ticket_code)
+
+    def poll(self):
+        """Return (ticket_code, result) if a validation finished, else None."""
+        try:
+            return self.results.get_nowait()
+        except queue.Empty:
+            return None
+
+    def run(self):
+        while True:
+            ticket_code = self.jobs.get()
+            result = validate_ticket(ticket_code, self.offline)
+            self.results.put((ticket_code, result))
+
+            if result["status"] == "valid":
+                beep_valid()
+            else:
+                beep_invalid()
+
+
+class FramePipeline:
+    """
+    Staged QR decoding tuned for low-power scanner boxes:
+
+      1. track  – if we saw a code last frame, decode only that region (ROI)
+      2. detect – otherwise run the cheap detect() on a downscaled frame
+      3. decode – full-resolution decode of just the ROI around the detection
+
+    Frames are skipped while a validation is pending, and the frame stride grows
+    when decoding exceeds FRAME_BUDGET. Per-stage timings (EMA, ms) and FPS are
+    kept in self.timings / self.fps.
+    """
+
+    def __init__(self):
+        self.detector = cv2.QRCodeDetector()
+        self.roi = None                  # (x0, y0, x1, y1) in full-res coords
+        self.stride = 1
+        self.frame_no = 0
+        self.timings = {"track": 0.0, "detect": 0.0, "decode": 0.0, "total": 0.0}
+        self.fps = 0.0
+        self._last_frame_at = None
+
+    def _ema(self, key, seconds):
+        ms = seconds * 1000
+        prev = self.timings[key]
+        self.timings[key] = 0.9 * prev + 0.1 * ms if prev else ms
+
+    def _tick_fps(self):
+        now = time.perf_counter()
+        if self._last_frame_at is not None:
+            inst = 1.0 / max(now - self._last_frame_at, 1e-6)
+            self.fps = 0.9 * self.fps + 0.1 * inst if self.fps else inst
+        self._last_frame_at = now
+
+    def _decode_roi(self, frame, roi):
+        x0, y0, x1, y1 = roi
+        data, points, _ = self.detector.detectAndDecode(frame[y0:y1, x0:x1])
+        if points is None or not data:
+            return None, None
+        return data, points[0] + (x0, y0)
+
+    def _roi_around(self, points, shape):
+        h, w = shape[:2]
+        x0, y0 = points.min(axis=0)
+        x1, y1 = points.max(axis=0)
+        mx = (x1 - x0) * ROI_MARGIN
+        my = (y1 - y0) * ROI_MARGIN
+        return (
+            max(int(x0 - mx), 0), max(int(y0 - my), 0),
+            min(int(x1 + mx), w), min(int(y1 + my), h),
+        )
+
+    def process(self, frame, busy=False):
+        """
+        Return (decoded_text, points) for this frame, or (None, None).
+        `busy` = a validation is in flight, so there is no point decoding.
+        """
+        self._tick_fps()
+        self.frame_no += 1
+        if busy or self.frame_no % self.stride:
+            return None, None
+
+        start = time.perf_counter()
+        data, points = None, None
+
+        # ---- stage 1: track the last known region ----
+        if self.roi is not None:
+            t = time.perf_counter()
+            data, points = self._decode_roi(frame, self.roi)
+            self._ema("track", time.perf_counter() - t)
+            if data is None:
+                self.roi = None
+
+        # ---- stage 2: cheap detect on a downscaled copy ----
+        if data is None:
+            t = time.perf_counter()
+            scale = min(DETECT_WIDTH / frame.shape[1], 1.0)
+            small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            found, small_points = self.detector.detect(small)
+            self._ema("detect", time.perf_counter() - t)
+
+            # ---- stage 3: full-res decode of only the detected region ----
+            if found and small_points is not None:
+                t = time.perf_counter()
+                roi = self._roi_around(small_points[0] / scale, frame.shape)
+                data, points = self._decode_roi(frame, roi)
+                self._ema("decode", time.perf_counter() - t)
+
+        if data is not None:
+            self.roi = self._roi_around(points, frame.shape)
+
+        # ---- adaptive frame skipping ----
+        spent = time.perf_counter() - start
+        self._ema("total", spent)
+        if spent > FRAME_BUDGET and self.stride < MAX_FRAME_STRIDE:
+            self.stride += 1
+        elif spent < FRAME_BUDGET / 2 and self.stride > 1:
+            self.stride -= 1
+
+        return data, points
+
+    def stats_line(self):
+        t = self.timings
+        return (
+            f"{self.fps:4.1f} fps | stride {self.stride} | track {t['track']:.1f}ms "
+            f"detect {t['detect']:.1f}ms decode {t['decode']:.1f}ms total {t['total']:.1f}ms"
+        )
+
+
+def result_overlay(ticket_code, result):
+    """Return (color, text, subtext) to show for a finished validation."""
+    # -------- SUCCESS CASES --------
+    if result["status"] == "valid":
+        if result["reason"] == "wallet_paid":
+            # Wallet payment just happened
+            pay_data = result["data"]
+            amount = pay_data.get("deducted_amount")
+            print("Wallet payment successful, fare deducted.")
+            offline_note = " (offline, syncs later)" if pay_data.get("offline") else ""
+            return (
+                (0, 200, 0),  # green
+                "TICKET VALID FARE DEDUCTED",
+                f"Ticket {ticket_code} | Deducted Rs{amount:.2f}{offline_note}",
+            )
+
+        # already_paid
+        print("Ticket already paid, allowing boarding.")
+        return (0, 200, 0), "TICKET VALID", f"Ticket {ticket_code} (already paid)"
+
+    # -------- FAILURE CASES --------
+    reason = result["reason"]
+    print("Ticket invalid:", reason)
+    return (0, 0, 255), "TICKET INVALID", f"Reason: {reason}"  # red
+
+
 def main():
+    global API_BASE
+
+    parser = argparse.ArgumentParser(description="ScanPayGo bus door scanner")
+    parser.add_argument("--bus", type=int, help="bus id; enables offline mode with a prefetched manifest")
+    parser.add_argument("--api", default=API_BASE, help="backend base URL")
+    parser.add_argument("--token", default=os.environ.get("SCANPAYGO_SCANNER_TOKEN"),
+                        help="scanner token set on the server (default: $SCANPAYGO_SCANNER_TOKEN)")
+    args = parser.parse_args()
+    API_BASE = args.api.rstrip("/")
+    if args.token:
+        # manifest download and offline sync are refused without it
+        SESSION.headers["X-Scanner-Token"] = args.token
+    elif args.bus is not None:
+        print("No scanner token: the manifest can't be downloaded or payments synced.")
+
+    # Same key as the server, or every signed code would be dropped as forged
+    try:
+        load_signing_key()
+    except RuntimeError as e:
+        print(e)
+        return
+
+    offline = None
+    if args.bus is not None:
+        offline = OfflineStore(args.bus)
+        if offline.refresh():
+            print(f"Manifest for bus {args.bus}: {len(offline.tickets)} tickets.")
+        else:
+            offline.mark_offline()
+            print(f"Offline – using saved manifest ({len(offline.tickets)} tickets).")
+        SyncWorker(offline).start()
+
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         print("Could not open camera.")
@@ -125,14 +550,18 @@ def main():
     cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
     cv2.resizeWindow(WINDOW_NAME, 800, 600)
 
-    detector = cv2.QRCodeDetector()
+    pipeline = FramePipeline()
+    worker = ValidationWorker(offline)
+    worker.start()
 
     last_code = None
     last_scan_time = 0
+    pending_code = None          # ticket currently being validated by the worker
     overlay_until = 0
     overlay_color = (0, 0, 0)
     overlay_text = ""
     overlay_subtext = ""
+    last_stats_at = time.time()
 
     print("Scanner started. Press 'q' to quit.\n")
 
@@ -141,13 +570,15 @@ def main():
         if not ret:
             break
 
+        # Decode on the raw frame; mirroring is only for the preview
+        data, points = pipeline.process(frame, busy=pending_code is not None)
+        width = frame.shape[1]
         frame = cv2.flip(frame, 1)
 
-        data, points, _ = detector.detectAndDecode(frame)
-
-        if points is not None and data:
+        if data:
             decoded_text = data
-            pts = points[0].astype(int)
+            pts = points.astype(int)
+            pts[:, 0] = width - 1 - pts[:, 0]
 
             # Draw polygon around QR
             for i in range(len(pts)):
@@ -156,74 +587,38 @@ def main():
                 cv2.line(frame, pt1, pt2, (255, 255, 0), 2)
 
             ticket_code = extract_ticket_code(decoded_text)
-            if ticket_code:
+            if ticket_code and pending_code is None:
                 now = time.time()
                 if ticket_code != last_code or now - last_scan_time > 3:
                     print(f"Scanned QR: {decoded_text} -> ticket_code={ticket_code}")
-                    result = validate_ticket(ticket_code)
+                    worker.submit(ticket_code)
+                    pending_code = ticket_code
                     last_code = ticket_code
                     last_scan_time = now
 
-                    # -------- SUCCESS CASES --------
-                    if result["status"] == "valid":
-                        if result["reason"] == "wallet_paid":
-                            # Wallet payment just happened
-                            pay_data = result["data"]
-                            amount = pay_data.get("deducted_amount")
-                            overlay_color = (0, 200, 0)  # green
-                            overlay_text = "TICKET VALID FARE DEDUCTED"
-                            overlay_subtext = f"Ticket {ticket_code} | Deducted Rs{amount:.2f}"
-                            print("Wallet payment successful, fare deducted.")
-                        else:
-                            # already_paid
-                            overlay_color = (0, 200, 0)
-                            overlay_text = "TICKET VALID"
-                            overlay_subtext = f"Ticket {ticket_code} (already paid)"
-                            print("Ticket already paid, allowing boarding.")
-
-                        beep_valid()
-
-                    # -------- FAILURE CASES --------
-                    else:
-                        reason = result["reason"]
-                        overlay_color = (0, 0, 255)  # red
-                        overlay_text = "TICKET INVALID"
-                        overlay_subtext = f"Reason: {reason}"
-                        print("Ticket invalid:", reason)
-                        beep_invalid()
-
-                    overlay_until = now + 2.5
+        # Pick up a finished validation (never blocks the camera loop)
+        done = worker.poll()
+        if done:
+            code, result = done
+            overlay_color, overlay_text, overlay_subtext = result_overlay(code, result)
+            overlay_until = time.time() + 2.5
+            last_scan_time = time.time()
+            pending_code = None
 
         # Overlay UI
         now2 = time.time()
-        if now2 < overlay_until:
-            overlay = frame.copy()
-            alpha = 0.6
-            cv2.rectangle(
-                overlay, (0, 0), (frame.shape[1], frame.shape[0]), overlay_color, -1
-            )
-            cv2.addWeighted(overlay, alpha, frame, 1 - alpha, 0, frame)
-
-            cv2.putText(
-                frame,
-                overlay_text,
-                (40, 100),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.9,
-                (255, 255, 255),
-                3,
-                cv2.LINE_AA,
-            )
-            cv2.putText(
-                frame,
-                overlay_subtext,
-                (40, 150),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.7,
-                (255, 255, 255),
-                2,
-                cv2.LINE_AA,
-            )
+        if pending_code is not None:
+            draw_overlay(frame, (0, 170, 255), "CHECKING...", f"Ticket {pending_code}")
+        elif now2 < overlay_until:
+            draw_overlay(frame, overlay_color, overlay_text, overlay_subtext)
+
+        cv2.putText(
+            frame, pipeline.stats_line(), (10, frame.shape[0] - 12),
+            cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1, cv2.LINE_AA,
+        )
+        if now2 - last_stats_at > STATS_EVERY:
+            print(pipeline.stats_line())
+            last_stats_at = now2
 
         cv2.imshow(WINDOW_NAME, frame)
 
@@ -234,5 +629,34 @@ def main():
     cv2.destroyAllWindows()
 
 
+def draw_overlay(frame, color, text, subtext):
+    """Tint a banner at the top of the frame and print the verdict on it."""
+    # blend only the banner strip in place – no full-frame copy
+    band = frame[0:190]
+    alpha = 0.6
+    cv2.addWeighted(np.full_like(band, color), alpha, band, 1 - alpha, 0, band)
+
+    cv2.putText(
+        frame,
+        text,
+        (40, 100),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        0.9,
+        (255, 255, 255),
+        3,
+        cv2.LINE_AA,
+    )
+    cv2.putText(
+        frame,
+        subtext,
+        (40, 150),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        0.7,
+        (255, 255, 255),
+        2,
+        cv2.LINE_AA,
+    )
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py migrates its database and loads the signing key on import:
+# point both somewhere harmless before the first import
+os.environ["SCANPAYGO_DB"] = os.path.join(tempfile.mkdtemp(prefix="scanpaygo-tests-"), "import.db")
+os.environ.setdefault("SCANPAYGO_TICKET_KEY", "scanpaygo-tests")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as scanpaygo  # noqa: E402
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """The app module on a fresh, migrated database with empty in-memory caches."""
+    monkeypatch.chdir(tmp_path)   # qr_store/ and friends
+    monkeypatch.setattr(scanpaygo, "DB_NAME", str(tmp_path / "tickets.db"))
+    monkeypatch.setattr(scanpaygo, "seat_holds", scanpaygo.SeatHolds(scanpaygo.SEAT_HOLD_TTL))
+    monkeypatch.setattr(scanpaygo, "payment_events", scanpaygo.PaymentEvents())
+    monkeypatch.setattr(scanpaygo, "bus_facets", scanpaygo.BusFacets())
+    monkeypatch.setattr(scanpaygo, "search_cache", scanpaygo.SearchCache(scanpaygo.SEARCH_CACHE_MAX))
+    monkeypatch.setattr(scanpaygo, "qr_cache", scanpaygo.QRCache(scanpaygo.QR_CACHE_MAX_BYTES))
+    scanpaygo.init_db()
+    return scanpaygo
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def user_client(client):
+    """A client logged in as a freshly registered passenger."""
+    client.post("/register", data={"name": "Asha", "email": "asha@example.com", "password": "pw"})
+    return client
+
+
+@pytest.fixture
+def sql_trace(app_module, monkeypatch):
+    """Every SQL statement run on connections opened from now on, values inlined."""
+    statements = []
+    open_connection = app_module.get_db_connection
+
+    def traced_connection():
+        conn = open_connection()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(app_module, "get_db_connection", traced_connection)
+    return statements
+
+
+def book(client, bus_id, seats):
+    """Book seats (a list of ints) through the form; returns the response."""
+    return client.post(
+        f"/book/{bus_id}",
+        data={"phone": "0700000000", "selected_seats": ",".join(map(str, seats))},
+        headers={"Accept": "application/json"},
+    )
@@ -0,0 +1,159 @@
+"""
+Stand-in for the ScanPayGo backend with a link you can cut, for testing the
+scanner's offline mode without the Flask app.
+
+It serves the three calls the scanner makes (/api/scan, /api/manifest,
+/api/sync_payments) from an in-memory ticket dict. The link has three modes:
+  - up:    answer normally
+  - stall: accept the request and never answer (a dropped mobile link)
+  - drop:  close the connection at once (backend down)
+
+Tests use FlakyBackend directly. By hand:
+    python tests/flaky_backend.py                       # prints codes, listens on :5099
+    python scanner.py --api http://127.0.0.1:5099 --bus 1 --token test
+    curl -X POST http://127.0.0.1:5099/_link/stall      # ...then /_link/up
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LINK_MODES = ("up", "stall", "drop")
+STALL_MAX = 30.0   # seconds a stalled request is held before the socket is closed
+
+
+class FlakyBackend:
+    def __init__(self, tickets, host="127.0.0.1", port=0):
+        # ticket_code -> [payment_status, remaining_amount]
+        self.tickets = {code: list(entry) for code, entry in tickets.items()}
+        self.mode = "up"
+        self.link_restored = threading.Event()
+        self.link_restored.set()
+        self.lock = threading.Lock()
+        self.scans = []      # codes of scans that got an answer
+        self.synced = []     # payments received through /api/sync_payments
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def close(self):
+        self.set_mode("up")   # release stalled handlers
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_mode(self, mode):
+        if mode not in LINK_MODES:
+            raise ValueError(f"link mode must be one of {LINK_MODES}")
+        self.mode = mode
+        if mode == "up":
+            self.link_restored.set()
+        else:
+            self.link_restored.clear()
+
+    # ----------------------- fake API ----------------------- #
+
+    def charge(self, code):
+        """Return (data, status) like /api/scan, charging an unpaid ticket."""
+        with self.lock:
+            entry = self.tickets.get(code)
+            if entry is None:
+                return {"valid": False, "reason": "Ticket Not Found"}, 404
+            if entry[0] == "PAID":
+                return {"valid": True, "ticket_code": code, "reason": "already_paid"}, 200
+            deducted = entry[1]
+            entry[:] = ["PAID", 0.0]
+            return {"valid": True, "ticket_code": code, "reason": "wallet_paid",
+                    "deducted_amount": deducted}, 200
+
+    def route(self, method, path, body):
+        m = re.fullmatch(r"/api/scan/([^/]+)", path)
+        if method == "POST" and m:
+            data, status = self.charge(m.group(1))
+            with self.lock:
+                self.scans.append(m.group(1))
+            return data, status
+        if method == "GET" and re.fullmatch(r"/api/manifest/\d+", path):
+            with self.lock:
+                return {"success": True, "tickets": {c: list(e) for c, e in self.tickets.items()}}, 200
+        if method == "POST" and path == "/api/sync_payments":
+            results = []
+            for p in (body or {}).get("payments", []):
+                data, _ = self.charge(p["ticket_code"])
+                results.append({
+                    "ticket_code": p["ticket_code"],
+                    "idempotency_key": p["idempotency_key"],
+                    "result": "charged" if "deducted_amount" in data else "already_paid",
+                    "reason": None,
+                    "deducted_amount": data.get("deducted_amount"),
+                })
+            with self.lock:
+                self.synced.extend(body.get("payments", []) if body else [])
+            return {"success": True, "results": results}, 200
+        return {"success": False, "reason": "not found"}, 404
+
+    def _handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.handle_api("GET")
+
+            def do_POST(self):
+                self.handle_api("POST")
+
+            def handle_api(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+
+                m = re.fullmatch(r"/_link/(\w+)", self.path)
+                if method == "POST" and m:   # control channel, never cut
+                    backend.set_mode(m.group(1))
+                    return self.reply({"mode": backend.mode}, 200)
+
+                if backend.mode == "stall":
+                    backend.link_restored.wait(STALL_MAX)
+                    self.close_connection = True
+                    return
+                if backend.mode == "drop":
+                    self.close_connection = True
+                    return
+
+                data, status = backend.route(method, self.path, json.loads(raw) if raw else None)
+                self.reply(data, status)
+
+            def reply(self, data, status):
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from ticket_codes import load_signing_key, sign_ticket_code
+
+    load_signing_key()
+    codes = {sign_ticket_code(i, 1): ["PENDING", 150.0] for i in range(1, 6)}
+    backend = FlakyBackend(codes, port=5099).start()
+    print(f"Stand-in backend on {backend.url}; ticket codes for bus 1:")
+    for code in codes:
+        print("  ", code)
+    print(f"Cut the link with: curl -X POST {backend.url}/_link/stall  (or drop / up)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        backend.close()
@@ -0,0 +1,100 @@
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from conftest import book
+
+BUS_ID = 1          # seeded with 40 seats
+THREADS = 8
+ATTEMPTS = 40       # bookings tried per thread
+
+
+def db(app_module):
+    conn = sqlite3.connect(app_module.DB_NAME)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def booked_count(conn):
+    """bus_seat_counts for the bus (no row until its first booking)."""
+    return conn.execute(
+        "SELECT COALESCE((SELECT booked FROM bus_seat_counts WHERE bus_id = ?), 0)", (BUS_ID,)
+    ).fetchone()[0]
+
+
+def test_out_of_range_seats_are_rejected(app_module, user_client):
+    for seats in ([999], [0], [40, 41]):
+        resp = book(user_client, BUS_ID, seats)
+        assert resp.status_code == 400
+        assert resp.get_json()["reason"] == "invalid_seat"
+
+    conn = db(app_module)
+    assert conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM ticket_seats").fetchone()[0] == 0
+    assert booked_count(conn) == 0
+    assert conn.execute("SELECT wallet_balance FROM users").fetchone()[0] == 2000.0
+    assert book(user_client, BUS_ID, [40]).status_code == 201
+
+
+def test_concurrent_bookings_never_double_sell(app_module):
+    """
+    THREADS passengers race for the same 40 seats. Every attempt must either
+    book or get a clean 409, and no seat may end up on two tickets.
+    Run with -s to see the throughput.
+    """
+    clients = []
+    for i in range(THREADS):
+        client = app_module.app.test_client()
+        client.post("/register", data={"name": f"p{i}", "email": f"p{i}@example.com", "password": "pw"})
+        clients.append(client)
+    conn = db(app_module)
+    conn.execute("UPDATE users SET wallet_balance = 1000000")
+    conn.commit()
+
+    statuses = Counter()
+    lock = threading.Lock()
+    start = threading.Barrier(THREADS)
+
+    def passenger(client, seed):
+        rng = random.Random(seed)
+        start.wait()
+        for _ in range(ATTEMPTS):
+            seats = rng.sample(range(1, 41), rng.choice((1, 2)))
+            status = book(client, BUS_ID, seats).status_code
+            with lock:
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=passenger, args=(c, i)) for i, c in enumerate(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - started
+
+    attempts = THREADS * ATTEMPTS
+    print(f"\n{attempts} booking attempts from {THREADS} threads in {seconds:.2f}s "
+          f"({attempts / seconds:.0f}/s): {dict(statuses)}")
+    assert set(statuses) <= {201, 409}, statuses
+
+    tickets = conn.execute(
+        "SELECT id, user_id, seat_numbers, deposit_amount FROM tickets WHERE bus_id = ?", (BUS_ID,)
+    ).fetchall()
+    assert len(tickets) == statuses[201]
+
+    sold = Counter(int(s) for t in tickets for s in t["seat_numbers"].split(","))
+    assert all(n == 1 for n in sold.values()), "double-sold seats: %s" % [s for s, n in sold.items() if n > 1]
+    claimed = {r["seat_no"] for r in conn.execute(
+        "SELECT seat_no FROM ticket_seats WHERE bus_id = ?", (BUS_ID,)
+    )}
+    assert claimed == set(sold)
+    assert booked_count(conn) == len(claimed)
+
+    # every successful booking took exactly one deposit, failed ones took none
+    deposits = Counter()
+    for t in tickets:
+        deposits[t["user_id"]] += t["deposit_amount"]
+    for user in conn.execute("SELECT id, wallet_balance FROM users"):
+        assert abs(1000000 - deposits[user["id"]] - user["wallet_balance"]) < 1e-6
@@ -0,0 +1,25 @@
+import re
+
+USERS_QUERY = re.compile(r"\bFROM users\b", re.IGNORECASE)
+
+
+def users_queries(statements):
+    return [s for s in statements if USERS_QUERY.search(s)]
+
+
+def test_book_page_reads_the_user_once(user_client, sql_trace):
+    resp = user_client.get("/book/1")
+    assert resp.status_code == 200
+    # the route and the navbar context processor share one row
+    assert len(users_queries(sql_trace)) == 1
+
+
+def test_user_row_never_carries_the_password(user_client, sql_trace):
+    user_client.get("/book/1")
+    (query,) = users_queries(sql_trace)
+    assert "password" not in query and "*" not in query
+
+
+def test_anonymous_page_reads_no_user(client, sql_trace):
+    client.get("/")
+    assert users_queries(sql_trace) == []
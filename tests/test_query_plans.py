@@ -0,0 +1,67 @@
+"""
+EXPLAIN QUERY PLAN checks for the hot list queries, so nobody reintroduces
+a full table scan. Statements are captured from the real routes (with their
+values inlined by the trace callback) and explained on the same database.
+"""
+import re
+import sqlite3
+
+import pytest
+
+from conftest import book
+
+TABLE_SCAN = re.compile(r"^SCAN (t|b|tickets|buses)\b")
+
+
+def plans(app_module, statements, marker):
+    """Plan lines of every captured statement that contains `marker`."""
+    conn = sqlite3.connect(app_module.DB_NAME)
+    try:
+        found = [
+            [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+            for sql in statements if marker in sql
+        ]
+    finally:
+        conn.close()
+    assert found, f"no statement containing {marker!r} was run"
+    return found
+
+
+def assert_indexed(plan, index):
+    assert any(f"USING INDEX {index} " in line for line in plan), plan
+    assert not any(TABLE_SCAN.match(line) for line in plan), plan
+    assert not any("TEMP B-TREE" in line for line in plan), plan
+
+
+@pytest.fixture
+def booked(user_client):
+    for seat in (1, 2, 3):
+        assert book(user_client, 1, [seat]).status_code == 201
+    return user_client
+
+
+def test_bus_search_by_route_and_date(app_module, booked, sql_trace):
+    booked.get("/buses?from_city=Chennai&to_city=Bangalore&travel_date=2030-01-01")
+    for plan in plans(app_module, sql_trace, "from_city = 'Chennai'"):
+        assert_indexed(plan, "idx_buses_route")
+        assert any("departure>? AND departure<?" in line for line in plan), plan
+
+
+@pytest.mark.parametrize("query, index", [
+    ("", "idx_tickets_booked_at"),
+    ("&bus_id=1", "idx_tickets_bus_booked"),
+    ("&status=PENDING", "idx_tickets_status_booked"),
+])
+def test_admin_tickets_keyset_page(app_module, booked, sql_trace, query, index):
+    with booked.session_transaction() as sess:
+        sess["is_admin"] = True
+    resp = booked.get(f"/admin/tickets?before_at=2099-01-01 00:00:00&before_id=99{query}")
+    resp.get_data()   # the page is streamed: run the query
+    for plan in plans(app_module, sql_trace, "ORDER BY t.booked_at DESC, t.id DESC LIMIT 101"):
+        assert_indexed(plan, index)
+
+
+def test_bookings_keyset_page(app_module, booked, sql_trace):
+    booked.get("/bookings?before_at=2099-01-01 00:00:00&before_id=99")
+    for plan in plans(app_module, sql_trace, "WHERE t.user_id = "):
+        assert_indexed(plan, "idx_tickets_user_booked")
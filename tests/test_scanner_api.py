@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import book
+
+TOKEN = "door-scanner-token"
+
+
+@pytest.fixture
+def scanner(app_module, client, monkeypatch):
+    """Headers of a configured door scanner."""
+    monkeypatch.setattr(app_module, "SCANNER_TOKEN", TOKEN)
+    return {"X-Scanner-Token": TOKEN}
+
+
+def test_manifest_needs_the_scanner_token(app_module, client, scanner, monkeypatch):
+    assert client.get("/api/manifest/1").status_code == 403
+    assert client.get("/api/manifest/1", headers={"X-Scanner-Token": "guess"}).status_code == 403
+    assert client.get("/api/manifest/1", headers=scanner).status_code == 200
+    monkeypatch.setattr(app_module, "SCANNER_TOKEN", None)
+    assert client.get("/api/manifest/1", headers=scanner).status_code == 503
+
+
+@pytest.mark.parametrize("body", [
+    ["x"],
+    {"payments": ["x"]},
+    {"payments": {"a": 1}},
+    {"payments": "SPG-1"},
+    {"payments": [{"ticket_code": 1, "idempotency_key": "k"}]},
+    {"payments": [{"ticket_code": "SPG-ABCDEFGH"}]},
+])
+def test_sync_payments_rejects_malformed_batches(client, scanner, body):
+    resp = client.post("/api/sync_payments", json=body, headers=scanner)
+    assert resp.status_code == 400
+    assert resp.get_json()["success"] is False
+
+
+def test_sync_payments_charges_once(app_module, user_client, scanner):
+    code = book(user_client, 1, [1]).get_json()["ticket_code"]
+    batch = {"payments": [{"ticket_code": code, "idempotency_key": "k1", "amount": 764.15}]}
+    first = user_client.post("/api/sync_payments", json=batch, headers=scanner).get_json()
+    again = user_client.post("/api/sync_payments", json=batch, headers=scanner).get_json()
+    assert first["results"][0]["result"] == "charged"
+    assert again["results"] == first["results"]
@@ -0,0 +1,99 @@
+"""
+Scanner offline mode against FlakyBackend: once the link drops, scans must
+stop waiting on the network and validate from the manifest straight away,
+and go back online (and sync) as soon as the backend answers again.
+"""
+import sys
+import time
+import types
+
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("requests")
+try:
+    import winsound  # noqa: F401
+except ImportError:   # Windows-only; the scanner just beeps with it
+    sys.modules["winsound"] = types.SimpleNamespace(Beep=lambda frequency, duration: None)
+
+import scanner  # noqa: E402
+from flaky_backend import FlakyBackend  # noqa: E402
+
+TICKETS = {f"SPG-TEST000{i}": ["PENDING", 100.0] for i in range(1, 10)}
+CODES = sorted(TICKETS)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = FlakyBackend(TICKETS).start()
+    monkeypatch.setattr(scanner, "API_BASE", backend.url)
+    monkeypatch.setattr(scanner, "CONNECT_TIMEOUT", 0.2)
+    monkeypatch.setattr(scanner, "SCAN_TIMEOUT", 0.5)
+    monkeypatch.setattr(scanner, "PROBE_INTERVAL", 0.05)
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def store(backend, tmp_path):
+    store = scanner.OfflineStore(1, str(tmp_path / "scanner_offline.db"))
+    assert store.refresh()
+    return store
+
+
+def timed_scan(code, store):
+    started = time.perf_counter()
+    result = scanner.validate_ticket(code, store)
+    return result, time.perf_counter() - started
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("mode", ["stall", "drop"])
+def test_only_the_first_scan_waits_for_a_dead_link(backend, store, mode):
+    result, _ = timed_scan(CODES[0], store)
+    assert result["reason"] == "wallet_paid" and "offline" not in result["data"]
+
+    backend.set_mode(mode)
+    result, first = timed_scan(CODES[1], store)
+    assert result["data"]["offline"] and not store.link_up()
+    assert first < scanner.CONNECT_TIMEOUT + scanner.SCAN_TIMEOUT + 0.5
+
+    # the rest of the queue boards at local speed, without touching the network
+    for code in CODES[2:]:
+        result, seconds = timed_scan(code, store)
+        assert result["status"] == "valid" and result["data"]["offline"]
+        assert seconds < 0.05
+    unknown, seconds = timed_scan("SPG-NOTONBUS", store)
+    assert unknown["status"] == "invalid" and seconds < 0.05
+    assert backend.scans == [CODES[0]]
+
+
+def test_link_comes_back_and_backlog_syncs(backend, store):
+    backend.set_mode("stall")
+    timed_scan(CODES[0], store)
+    timed_scan(CODES[1], store)
+    assert len(store.unsynced()) == 2
+
+    worker = scanner.SyncWorker(store)
+    worker.start()
+    try:
+        time.sleep(0.3)   # probes fail while the link is still down
+        assert not store.link_up()
+
+        backend.set_mode("up")
+        wait_for(store.link_up)
+        wait_for(lambda: not store.unsynced())
+        assert sorted(p["ticket_code"] for p in backend.synced) == CODES[:2]
+
+        result, _ = timed_scan(CODES[2], store)
+        assert result["reason"] == "wallet_paid" and "offline" not in result["data"]
+        assert backend.scans == [CODES[2]]
+    finally:
+        worker.stop()
+        worker.join(2)
@@ -0,0 +1,19 @@
+import pytest
+
+from conftest import book
+
+
+@pytest.mark.parametrize("body", [[1, 2], "SPG-1", {"codes": "SPG-1"}, {"codes": [1]}, {}])
+def test_rejects_malformed_bodies(client, body):
+    resp = client.post("/api/validate_batch", json=body)
+    assert resp.status_code == 400
+    assert resp.get_json()["success"] is False
+
+
+def test_results_keep_request_order(user_client):
+    code = book(user_client, 1, [1]).get_json()["ticket_code"]
+    resp = user_client.post("/api/validate_batch", json={"codes": ["SPG-BAD", code, code]})
+    results = resp.get_json()["results"]
+    assert [r["ticket_code"] for r in results] == ["SPG-BAD", code, code]
+    assert [r["http_status"] for r in results] == [404, 400, 400]
+    assert results[1]["reason"] == "unpaid"
@@ -0,0 +1,44 @@
+import sqlite3
+
+from conftest import book
+
+
+def pay(client, code, key):
+    return client.post(f"/api/wallet_pay/{code}", headers={"Idempotency-Key": key})
+
+
+def test_retry_returns_the_first_answer(user_client):
+    code = book(user_client, 1, [1]).get_json()["ticket_code"]
+    first = pay(user_client, code, "k1")
+    again = pay(user_client, code, "k1")
+    assert first.status_code == again.status_code == 200
+    assert again.get_json() == first.get_json()
+
+
+def test_key_reused_for_another_ticket_is_refused(user_client):
+    a = book(user_client, 1, [1]).get_json()["ticket_code"]
+    b = book(user_client, 1, [2]).get_json()["ticket_code"]
+    assert pay(user_client, a, "k1").status_code == 200
+    resp = pay(user_client, b, "k1")
+    assert resp.status_code == 409
+    assert resp.get_json() == {"success": False, "reason": "idempotency_key_reused"}
+    assert user_client.get(f"/api/validate/{b}").get_json()["reason"] == "unpaid"
+
+
+def test_non_object_json_body_is_not_a_key(user_client):
+    code = book(user_client, 1, [1]).get_json()["ticket_code"]
+    assert user_client.post(f"/api/wallet_pay/{code}", json=[1, 2]).status_code == 200
+    assert user_client.post(f"/api/scan/{code}", json={"idempotency_key": 5}).status_code == 200
+
+
+def test_expired_keys_are_pruned(app_module, user_client):
+    a = book(user_client, 1, [1]).get_json()["ticket_code"]
+    b = book(user_client, 1, [2]).get_json()["ticket_code"]
+    pay(user_client, a, "old")
+    conn = sqlite3.connect(app_module.DB_NAME)
+    conn.execute("UPDATE payment_requests SET created_at = '2000-01-01 00:00:00'")
+    conn.commit()
+
+    pay(user_client, b, "new")
+    keys = [k for (k,) in conn.execute("SELECT idempotency_key FROM payment_requests")]
+    assert keys == ["new"]
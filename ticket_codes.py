@@ -0,0 +1,122 @@
+"""
+Self-verifying ticket codes, shared by the Flask app and the door scanner.
+
+New codes look like SPG-<ticket id>-<bus id>-<nonce>-<tag>:
+  - ids are base 36 (0-9, A-Z)
+  - nonce is 10 random bytes, base32, so even a key holder cannot derive
+    another passenger's code from its ticket and bus ids
+  - tag is the first 10 bytes of HMAC-SHA256("<ticket id>:<bus id>:<nonce>"), base32
+So a forged or mistyped code is rejected in microseconds, without SQLite.
+
+The key comes from SCANPAYGO_TICKET_KEY, or else from the key file
+(SCANPAYGO_TICKET_KEY_FILE, default ticket_key.secret next to this module).
+The server creates the file on first start; scanners need a copy of it.
+
+Old random codes (SPG- + 8 chars) carry no signature; they are still
+accepted by shape and checked against the database as before.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+
+KEY_FILE = os.environ.get(
+    "SCANPAYGO_TICKET_KEY_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "ticket_key.secret"),
+)
+SIGNING_KEY = None   # set by load_signing_key()
+
+NONCE_BYTES = 10   # 80 random bits -> 16 base32 chars
+TAG_BYTES = 10     # 80-bit tag -> 16 base32 chars
+
+SIGNED_RE = re.compile(r"SPG-([0-9A-Z]{1,13})-([0-9A-Z]{1,13})-([A-Z2-7]{16})-([A-Z2-7]{16})")
+LEGACY_RE = re.compile(r"SPG-[A-Z0-9]{8}")
+# signed form first, so a signed code is never cut down to its legacy-looking prefix
+FIND_RE = re.compile(
+    r"SPG-[0-9A-Z]{1,13}-[0-9A-Z]{1,13}-[A-Z2-7]{16}-[A-Z2-7]{16}|SPG-[A-Z0-9]{8}(?![A-Z0-9-])"
+)
+
+_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def _base36(n):
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _DIGITS[r] + out
+        if n == 0:
+            return out
+
+
+def load_signing_key(create=False):
+    """
+    Load the HMAC key from SCANPAYGO_TICKET_KEY or the key file.
+    With create=True (the server) a missing file is filled with a fresh random
+    key; otherwise (scanners) a missing key is an error, never a default.
+    """
+    global SIGNING_KEY
+    key = os.environ.get("SCANPAYGO_TICKET_KEY")
+    if not key:
+        try:
+            with open(KEY_FILE, encoding="ascii") as f:
+                key = f.read().strip()
+        except FileNotFoundError:
+            if not create:
+                raise RuntimeError(
+                    f"No ticket signing key: set SCANPAYGO_TICKET_KEY or copy the server's {KEY_FILE}"
+                )
+            key = secrets.token_hex(32)
+            try:
+                fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:   # another worker created it first
+                return load_signing_key()
+            with os.fdopen(fd, "w", encoding="ascii") as f:
+                f.write(key + "\n")
+    if not key:
+        raise RuntimeError(f"Ticket signing key in {KEY_FILE} is empty")
+    SIGNING_KEY = key.encode()
+    return SIGNING_KEY
+
+
+def _tag(ticket_id, bus_id, nonce):
+    if SIGNING_KEY is None:
+        raise RuntimeError("ticket signing key not loaded (call load_signing_key first)")
+    mac = hmac.new(SIGNING_KEY, f"{ticket_id}:{bus_id}:{nonce}".encode(), hashlib.sha256).digest()
+    return base64.b32encode(mac[:TAG_BYTES]).decode()
+
+
+def sign_ticket_code(ticket_id, bus_id):
+    """Build a signed code for a ticket, with a fresh random nonce."""
+    nonce = base64.b32encode(secrets.token_bytes(NONCE_BYTES)).decode()
+    return f"SPG-{_base36(ticket_id)}-{_base36(bus_id)}-{nonce}-{_tag(ticket_id, bus_id, nonce)}"
+
+
+def parse_ticket_code(code):
+    """
+    Return (ticket_id, bus_id) for a correctly signed code,
+    (None, None) for a legacy-format code, or None if the code is bad.
+    """
+    m = SIGNED_RE.fullmatch(code)
+    if m:
+        ticket_id, bus_id = int(m.group(1), 36), int(m.group(2), 36)
+        if hmac.compare_digest(m.group(4), _tag(ticket_id, bus_id, m.group(3))):
+            return ticket_id, bus_id
+        return None
+    if LEGACY_RE.fullmatch(code):
+        return None, None
+    return None
+
+
+def verify_ticket_code(code):
+    """True if the code is worth a database lookup."""
+    return parse_ticket_code(code) is not None
+
+
+def find_ticket_code(text):
+    """Pull a valid-looking ticket code out of QR content (URL or bare code)."""
+    m = FIND_RE.search(text)
+    if m and verify_ticket_code(m.group(0)):
+        return m.group(0)
+    return None